@@ -0,0 +1,114 @@
+import json
+import os
+import platform
+import statistics
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Tuple
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Every benchmark is run on a scaled-down synthetic population and on the
+# population of the configured area (AREA_NAME).
+POPULATIONS = ('synthetic', 'area')
+
+
+@dataclass
+class Benchmark:
+    id: str
+    # Called once per population. Returns a (run, reset) pair, where `run` is
+    # the timed callable and `reset` (optional) is called before each repeat
+    # outside of the timed region.
+    setup: Callable[[str], Tuple[Callable, Callable]]
+    repeat: int = 5
+    populations: tuple = POPULATIONS
+
+
+BENCHMARKS = []
+
+
+def benchmark(id, repeat=5, populations=POPULATIONS):
+    def wrapper(func):
+        BENCHMARKS.append(Benchmark(id=id, setup=func, repeat=repeat, populations=populations))
+        return func
+    return wrapper
+
+
+def run_benchmarks(only=None, populations=POPULATIONS, repeat=None):
+    results = {}
+
+    for bm in BENCHMARKS:
+        if only and bm.id not in only:
+            continue
+        for population in bm.populations:
+            if population not in populations:
+                continue
+
+            run, reset = bm.setup(population)
+            times = []
+            for i in range(repeat or bm.repeat):
+                if reset is not None:
+                    reset()
+                start = time.perf_counter_ns()
+                run()
+                times.append((time.perf_counter_ns() - start) / 1000000)
+            if reset is not None:
+                reset()
+
+            key = '%s[%s]' % (bm.id, population)
+            results[key] = dict(
+                min_ms=min(times), median_ms=statistics.median(times), repeat=len(times)
+            )
+            print('%-50s %12.2f ms (median %.2f ms, %d runs)' % (
+                key, results[key]['min_ms'], results[key]['median_ms'], len(times)
+            ))
+
+    return results
+
+
+def save_results(results, path=BASELINE_PATH):
+    data = dict(
+        created_at=datetime.now().isoformat(timespec='seconds'),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpu_count=os.cpu_count(),
+        results=results,
+    )
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load_results(path=BASELINE_PATH):
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+
+def compare_results(results, baseline, threshold=0.10):
+    """Prints the change of each benchmark against the baseline.
+
+    Returns the keys of the benchmarks whose minimum time regressed by more
+    than `threshold` (a fraction of the baseline).
+    """
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print('%-50s %12s' % (key, 'no baseline'))
+            continue
+        if not base['min_ms']:
+            # Too fast to measure, so there is nothing to compare against
+            print('%-50s %12.2f ms -> %12.2f ms %9s' % (key, base['min_ms'], res['min_ms'], 'n/a'))
+            continue
+        change = res['min_ms'] / base['min_ms'] - 1
+        if change > threshold:
+            status = 'REGRESSION'
+            regressions.append(key)
+        elif change < -threshold:
+            status = 'improvement'
+        else:
+            status = ''
+        print('%-50s %12.2f ms -> %12.2f ms %+7.1f %% %s' % (
+            key, base['min_ms'], res['min_ms'], change * 100, status
+        ))
+    return regressions
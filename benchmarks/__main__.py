@@ -0,0 +1,39 @@
+import argparse
+import sys
+
+from . import BASELINE_PATH, POPULATIONS, compare_results, load_results, run_benchmarks, save_results
+from . import cache, simulation  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the simulation benchmarks')
+    parser.add_argument('--only', nargs='+', help='run only the given benchmarks')
+    parser.add_argument('--population', choices=POPULATIONS, help='run only on the given population')
+    parser.add_argument('--repeat', type=int, help='override the number of repeats')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path to the baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results against the baseline')
+    parser.add_argument(
+        '--threshold', type=float, default=0.10,
+        help='relative slowdown that is reported as a regression (default 0.10)'
+    )
+    args = parser.parse_args()
+
+    populations = (args.population,) if args.population else POPULATIONS
+    results = run_benchmarks(only=args.only, populations=populations, repeat=args.repeat)
+
+    regressions = []
+    if args.compare:
+        print()
+        regressions = compare_results(results, load_results(args.baseline), args.threshold)
+
+    if args.save:
+        save_results(results, args.baseline)
+
+    if regressions:
+        print('\n%d benchmark(s) regressed' % len(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import pickle
+
+from calc.datasets import get_mobility_data
+from common import cache_serialization
+
+from . import benchmark
+from .simulation import get_finished_run
+
+# 'pickle' is the in-band pickle that flask-caching stores. The rest are
+# cache_serialization with the given compression.
+FORMATS = ['pickle', 'none'] + [
+    name for name in cache_serialization.CODECS if cache_serialization.is_codec_available(name)
+]
+
+
+def get_cached_objects(population):
+    """Returns the largest values that are stored in the cache"""
+
+    df, adf = get_finished_run(population)
+    objects = dict(simulation_results=dict(total=df, age_groups=adf))
+    if population == 'area':
+        objects['mobility_data'] = get_mobility_data()
+    return objects
+
+
+def get_serializer(fmt):
+    if fmt == 'pickle':
+        return pickle.dumps, pickle.loads
+
+    compression = fmt if fmt != 'none' else None
+
+    def dumps(obj):
+        return cache_serialization.dumps(obj, compression)
+
+    return dumps, cache_serialization.loads
+
+
+def print_sizes(fmt, population, dumped):
+    for name, data in dumped.items():
+        print('%-50s %12d bytes' % ('cache_size_%s[%s] %s' % (fmt, population, name), len(data)))
+
+
+def register_format(fmt):
+    dumps, loads = get_serializer(fmt)
+
+    @benchmark('cache_dumps_%s' % fmt, repeat=20)
+    def cache_dumps(population):
+        objects = list(get_cached_objects(population).values())
+
+        def run():
+            for obj in objects:
+                dumps(obj)
+
+        return run, None
+
+    @benchmark('cache_loads_%s' % fmt, repeat=20)
+    def cache_loads(population):
+        dumped = {name: dumps(obj) for name, obj in get_cached_objects(population).items()}
+        print_sizes(fmt, population, dumped)
+        data = list(dumped.values())
+
+        def run():
+            for d in data:
+                loads(d)
+
+        return run, None
+
+
+for fmt in FORMATS:
+    register_format(fmt)
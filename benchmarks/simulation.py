@@ -0,0 +1,146 @@
+import pandas as pd
+
+from calc.simulation import (
+    create_context, create_disease_params, create_population_params,
+    get_contacts_per_day, run_context, simulate_individuals,
+)
+from calc.utils import generate_cache_key
+from cythonsim import model, simrandom
+from variables import copy_variables
+
+from . import benchmark
+
+SYNTHETIC_POPULATION_SIZE = 20000
+
+# The epidemic is considered to be at its peak when the number of infected
+# has dropped this much from the highest value seen so far.
+PEAK_DECLINE = 0.9
+PEAK_MIN_INFECTED = 100
+
+_peak_contexts = {}
+_finished_runs = {}
+
+
+def get_age_structure(population, variables):
+    if population == 'area':
+        return None
+
+    max_age = variables['max_age']
+    per_age = SYNTHETIC_POPULATION_SIZE // (max_age + 1)
+    return pd.Series([per_age] * (max_age + 1), index=range(0, max_age + 1))
+
+
+def make_context(population, variables):
+    return create_context(variables, age_structure=get_age_structure(population, variables))
+
+
+def get_peak_context(population):
+    """Returns a context that has been iterated up to the first epidemic peak"""
+
+    if population in _peak_contexts:
+        return _peak_contexts[population]
+
+    variables = copy_variables()
+    context = make_context(population, variables)
+    peak = 0
+    for day in range(variables['simulation_days']):
+        infected = context.generate_state()['infected'].sum()
+        if peak >= PEAK_MIN_INFECTED and infected < peak * PEAK_DECLINE:
+            break
+        if infected > peak:
+            peak = infected
+        context.iterate()
+
+    _peak_contexts[population] = context
+    return context
+
+
+def get_finished_run(population):
+    if population not in _finished_runs:
+        variables = copy_variables()
+        _finished_runs[population] = run_context(make_context(population, variables), variables)
+    return _finished_runs[population]
+
+
+@benchmark('population_construction')
+def population_construction(population):
+    variables = copy_variables()
+    params = create_population_params(variables, get_age_structure(population, variables))
+    disease = model.Disease(create_disease_params(variables))
+    random = simrandom.RandomPool(variables['random_seed'])
+    built = []
+
+    def run():
+        built.append(model.Population(dict(params), disease, random))
+
+    # Free the agents outside of the timed region
+    return run, built.clear
+
+
+@benchmark('context_clone')
+def context_clone(population):
+    context = make_context(population, copy_variables())
+    clones = []
+
+    def run():
+        clones.append(context.clone())
+
+    return run, clones.clear
+
+
+@benchmark('contact_probabilities', populations=('area',))
+def contact_probabilities(population):
+    # The contact matrix depends only on the age range, not on the population
+    variables = copy_variables()
+    cm = model.ContactMatrix(get_contacts_per_day(), variables['max_age'] + 1)
+    cm.set_mobility_factor(0.8)
+    cm.set_mobility_factor(0.5, min_age=7, max_age=12)
+
+    return cm.generate_contact_probabilities, None
+
+
+@benchmark('generate_state', repeat=20)
+def generate_state(population):
+    context = get_peak_context(population)
+    return context.generate_state, None
+
+
+@benchmark('peak_day_step')
+def peak_day_step(population):
+    # Consecutive repeats step consecutive days around the peak.
+    context = get_peak_context(population)
+    del _peak_contexts[population]
+    return context.iterate, None
+
+
+@benchmark('full_run', repeat=1)
+def full_run(population):
+    variables = copy_variables()
+
+    def run():
+        _finished_runs[population] = run_context(make_context(population, variables), variables)
+
+    return run, None
+
+
+@benchmark('results_to_metrics', repeat=20)
+def results_to_metrics(population):
+    from graphql_schema import results_to_metrics
+
+    df, adf = get_finished_run(population)
+    results = dict(total=df, age_groups=adf)
+
+    def run():
+        results_to_metrics(results)
+
+    return run, None
+
+
+@benchmark('cache_key', repeat=50, populations=('area',))
+def cache_key(population):
+    variables = copy_variables()
+
+    def run():
+        generate_cache_key(simulate_individuals, var_store=variables)
+
+    return run, None
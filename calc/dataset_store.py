@@ -0,0 +1,147 @@
+"""Parsed copies of the raw input datasets.
+
+Each source file is parsed once into a directory of .npy files, one per
+column, under `<DATASET_PATH>/parsed`. The copy is keyed by the mtime of the
+source, so a changed source is parsed again. Loading the columns is much
+faster than parsing the source, but the frame is still read into memory:
+pandas consolidates the columns into blocks, which would copy memory-mapped
+columns anyway.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from common import cache_stats
+from utils.data import get_dataset_path
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+
+
+def get_store_dir():
+    return os.path.join(get_dataset_path(), 'parsed')
+
+
+def get_store_path(name, source_path):
+    data = dict(
+        source=os.path.abspath(source_path),
+        mtime=os.path.getmtime(source_path),
+        version=STORE_FORMAT_VERSION,
+    )
+    digest = hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    return os.path.join(get_store_dir(), '%s-%s' % (name, digest))
+
+
+def _column_to_array(s):
+    if s.dtype != object:
+        return s.values, None
+
+    mask = s.isna().values
+    if not mask.any():
+        mask = None
+    values = s.values
+    if mask is not None:
+        values = np.where(mask, '', values)
+    if not all(isinstance(x, str) for x in values):
+        raise TypeError('Column %s has values that cannot be stored' % s.name)
+    return np.array(values, dtype=str), mask
+
+
+def write_frame(df, path):
+    """Writes `df` atomically as one .npy file per column to `path`"""
+
+    store_dir = os.path.dirname(path)
+    os.makedirs(store_dir, exist_ok=True)
+
+    index_names = [x if x is not None else '__index_%d__' % i for i, x in enumerate(df.index.names)]
+    df = df.reset_index()
+    df.columns = index_names + list(df.columns[len(index_names):])
+
+    columns = []
+    tmp_path = tempfile.mkdtemp(dir=store_dir, prefix='.tmp-')
+    try:
+        for idx, col in enumerate(df.columns):
+            arr, mask = _column_to_array(df[col])
+            np.save(os.path.join(tmp_path, '%d.npy' % idx), arr)
+            if mask is not None:
+                np.save(os.path.join(tmp_path, '%d-mask.npy' % idx), mask)
+            columns.append(dict(name=col, is_str=arr.dtype.kind == 'U', has_mask=mask is not None))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(dict(columns=columns, index=index_names), f)
+        os.rename(tmp_path, path)
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        # Another process may have stored the same frame first
+        if not isinstance(e, OSError) or not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+
+
+def read_frame(path):
+    """Loads the frame stored at `path`. Returns None if there is none."""
+
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    data = {}
+    for idx, col in enumerate(meta['columns']):
+        # Not memory-mapped: pd.DataFrame() stacks the columns of each dtype
+        # into one block, so a mapped column would be copied right away, and
+        # the string columns are converted into objects below.
+        arr = np.load(os.path.join(path, '%d.npy' % idx))
+        if col['is_str']:
+            arr = arr.astype(object)
+            if col['has_mask']:
+                arr[np.load(os.path.join(path, '%d-mask.npy' % idx))] = None
+        data[col['name']] = arr
+
+    df = pd.DataFrame(data, columns=[col['name'] for col in meta['columns']])
+    df = df.set_index(meta['index'])
+    df.index.names = [None if x.startswith('__index_') else x for x in meta['index']]
+    return df
+
+
+def remove_stale_copies(name, current_path):
+    store_dir = get_store_dir()
+    prefix = '%s-' % name
+    for fn in os.listdir(store_dir):
+        path = os.path.join(store_dir, fn)
+        if not fn.startswith(prefix) or path == current_path:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_dataset(name, source_path, parse):
+    """Returns the frame parsed from `source_path` by `parse()`.
+
+    The parsed frame is stored on first use and loaded from the store
+    afterwards, until the source file changes.
+    """
+    start = time.perf_counter()
+    path = get_store_path(name, source_path)
+    df = read_frame(path)
+    if df is not None:
+        result = 'loaded'
+    else:
+        df = parse()
+        result = 'parsed'
+        try:
+            write_frame(df, path)
+            remove_stale_copies(name, path)
+        except (OSError, TypeError) as e:
+            logger.warning('Unable to store dataset %s: %s' % (name, e))
+
+    ms = (time.perf_counter() - start) * 1000
+    cache_stats.observe('dataset:%s' % name, '%s_ms' % result, ms)
+    logger.info('Dataset %s %s in %.0f ms' % (name, result, ms))
+    return df
@@ -8,19 +8,19 @@ from utils.data import get_dataset_path
 from data_import.google_covid_mobility import DATASET_ZIP_NAME as MOBILITY_DATASET_FILENAME
 
 from . import calcfunc
+from .dataset_store import load_dataset
 
 
 POPULATION_CSV_PATH = add_root_path('data/005_11re_2019.csv')
+HEALTHCARE_DISTRICTS_XLS_PATH = add_root_path('data/shp_jasenkunnat_2020.xls')
+CONTACT_MATRIX_CSV_PATH = add_root_path('data/contact_matrix.csv')
 
 
-@calcfunc(
-    filedeps=[POPULATION_CSV_PATH]
-)
-def get_population():
-    f = open(POPULATION_CSV_PATH, 'r', encoding='iso8859-1')
-    f.readline()
-    f.readline()
-    df = pd.read_csv(f, delimiter=';', quotechar='"')
+def _parse_population():
+    with open(POPULATION_CSV_PATH, 'r', encoding='iso8859-1') as f:
+        f.readline()
+        f.readline()
+        df = pd.read_csv(f, delimiter=';', quotechar='"')
     df = df[(df.Alue != 'KOKO MAA') & (df['Ikä'] != 'Yhteensä')]
     df = df.rename(columns={
         'Miehet 2019 Väestö 31.12.': 'Male',
@@ -37,15 +37,27 @@ def get_population():
     return df.set_index('Area')
 
 
-@calcfunc()
-def get_healthcare_districts():
-    p = get_root_path() + '/data/shp_jasenkunnat_2020.xls'
-    df = pd.read_excel(p, header=3, sheet_name='shp_jäsenkunnat_2020_lkm')
+@calcfunc(
+    filedeps=[POPULATION_CSV_PATH]
+)
+def get_population():
+    return load_dataset('population', POPULATION_CSV_PATH, _parse_population)
+
+
+def _parse_healthcare_districts():
+    df = pd.read_excel(HEALTHCARE_DISTRICTS_XLS_PATH, header=3, sheet_name='shp_jäsenkunnat_2020_lkm')
     df = df[['kunta', 'sairaanhoitopiiri', 'erva-alue']].dropna()
     return df
 
 
-@calcfunc(variables=['area_name'])
+@calcfunc(
+    filedeps=[HEALTHCARE_DISTRICTS_XLS_PATH]
+)
+def get_healthcare_districts():
+    return load_dataset('healthcare_districts', HEALTHCARE_DISTRICTS_XLS_PATH, _parse_healthcare_districts)
+
+
+@calcfunc(variables=['area_name'], funcs=[get_population, get_healthcare_districts])
 def get_population_for_area(variables):
     area = variables['area_name']
     df = get_population()
@@ -61,12 +73,15 @@ def get_population_for_area(variables):
     return df
 
 
+def _parse_contact_matrix():
+    return pd.read_csv(CONTACT_MATRIX_CSV_PATH, header=0)
+
+
 @calcfunc(variables=['country', 'max_age'])
 def get_contacts_for_country(variables):
-    f = open(get_root_path() + '/data/contact_matrix.csv', 'r')
     max_age = variables['max_age']
 
-    df = pd.read_csv(f, header=0)
+    df = load_dataset('contact_matrix', CONTACT_MATRIX_CSV_PATH, _parse_contact_matrix)
     df = df[df.country == variables['country']].drop(columns='country')
 
     df['place_type'] = df['place_type'].map(lambda x: x.replace('cnt_', '').replace('otherplace', 'other'))
@@ -86,16 +101,22 @@ AREA_CASEFILES = {
 }
 
 
+def _read_casefile(area_name):
+    casefile = AREA_CASEFILES[area_name]
+    name = 'casefile_%s' % ''.join(c if c.isalnum() else '_' for c in area_name.lower())
+    return load_dataset(name, casefile, lambda: pd.read_csv(casefile, header=0))
+
+
 @calcfunc(
     variables=['area_name'],
-    filedeps=list(AREA_CASEFILES.values())
+    filedeps=list(AREA_CASEFILES.values()),
+    stale_while_revalidate=True,
 )
 def get_detected_cases(variables):
     area_name = variables['area_name']
     assert area_name in AREA_CASEFILES
 
-    casefile = AREA_CASEFILES[area_name]
-    df = pd.read_csv(casefile, header=0)
+    df = _read_casefile(area_name)
     df['date'] = pd.to_datetime(df['date']).dt.date
     df = df.set_index('date')
     df = df.drop(columns='hospitalized').rename(columns=dict(confirmed='all_detected'))
@@ -147,7 +168,8 @@ def get_initial_population_condition(variables) -> InitialPopulationCondition:
     start_date = variables['start_date']
 
     casefile = AREA_CASEFILES[area_name]
-    df = pd.read_csv(casefile, header=0, index_col=0)
+    df = _read_casefile(area_name)
+    df = df.set_index(df.columns[0])
     try:
         ds = df.loc[start_date]
     except (ValueError, KeyError) as e:
@@ -178,7 +200,8 @@ MOBILITY_FILE_PATH = os.path.join(get_dataset_path(), MOBILITY_DATASET_FILENAME)
 
 @calcfunc(
     variables=['area_name', 'country'],
-    filedeps=[MOBILITY_FILE_PATH]
+    filedeps=[MOBILITY_FILE_PATH],
+    stale_while_revalidate=True,
 )
 def get_mobility_data(variables):
     csv_fn = '2020_%s_Region_Mobility_Report.csv' % variables['country']
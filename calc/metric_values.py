@@ -0,0 +1,107 @@
+"""Daily metric values of the input datasets, prepared for the API.
+
+The values are computed once per area and horizon and cached like any other
+calcfunc, so they are recomputed only when the source files change.
+"""
+import base64
+from datetime import date, timedelta
+
+import numpy as np
+
+from calc import calcfunc
+from calc.datasets import get_detected_cases, get_mobility_data
+
+
+def to_float_array(s):
+    """Returns the values of the Series `s` as float64 with NaN in place of missing values"""
+
+    return s.to_numpy(dtype='float64', na_value=np.nan)
+
+
+def to_json_values(arr, is_integer):
+    """Returns the values of the float array `arr` as a list with None in place of NaN"""
+
+    mask = np.isnan(arr)
+    if is_integer:
+        values = np.where(mask, 0, arr).astype(np.int64).tolist()
+    else:
+        values = arr.tolist()
+    for idx in np.flatnonzero(mask):
+        values[idx] = None
+    return values
+
+
+def encode_values(arr, is_integer):
+    """Returns the values of `arr` as a base64-encoded buffer.
+
+    The values are little-endian int32 or float32 in row-major order. Missing
+    values are marked in a bitmap, bit i (least significant bit first) set
+    for the ith value, which is omitted if no values are missing.
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.kind in 'iu':
+        mask = None
+    else:
+        mask = np.isnan(arr)
+        if not mask.any():
+            mask = None
+
+    if is_integer:
+        if mask is not None:
+            arr = np.where(mask, 0, arr)
+        data = arr.astype('<i4')
+        dtype = 'int32'
+    else:
+        data = arr.astype('<f4')
+        dtype = 'float32'
+
+    if mask is not None:
+        null_bitmap = base64.b64encode(np.packbits(mask.ravel(), bitorder='little').tobytes()).decode('ascii')
+    else:
+        null_bitmap = None
+
+    return dict(
+        dtype=dtype,
+        shape=list(arr.shape),
+        data=base64.b64encode(np.ascontiguousarray(data).tobytes()).decode('ascii'),
+        null_bitmap=null_bitmap,
+    )
+
+
+@calcfunc(
+    variables=['start_date', 'simulation_days'],
+    funcs=[get_detected_cases],
+    stale_while_revalidate=True,
+)
+def get_validation_values(variables):
+    """Returns the dates and the values of the detected cases up to the end of the simulation"""
+
+    df = get_detected_cases()
+    sim_start = date.fromisoformat(variables['start_date'])
+    sim_end = sim_start + timedelta(days=variables['simulation_days'])
+    df = df[df.index < sim_end].copy()
+    df['detected'] = df['all_detected'].diff().rolling(window=14).mean().round()
+    arrays = {col: to_float_array(df[col]) for col in df.columns}
+
+    return dict(
+        dates=df.index.astype(str).tolist(),
+        values={col: to_json_values(arr, True) for col, arr in arrays.items()},
+        arrays=arrays,
+    )
+
+
+@calcfunc(
+    funcs=[get_mobility_data],
+    stale_while_revalidate=True,
+)
+def get_mobility_change_values():
+    """Returns the dates and the 7-day means of the mobility changes by place"""
+
+    df = get_mobility_data().rolling(7).mean().round().dropna(how='all')
+    arrays = {col: to_float_array(df[col]) for col in df.columns}
+
+    return dict(
+        dates=df.index.astype(str).tolist(),
+        values={col: to_json_values(arr, True) for col, arr in arrays.items()},
+        arrays=arrays,
+    )
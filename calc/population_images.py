@@ -0,0 +1,127 @@
+"""Prebuilt images of the pristine simulation population.
+
+An image holds the initial agent array, the age-sorted index and the contact
+probability tables of an area as .npy files, and the small remaining state
+as JSON. Every run maps the arrays copy-on-write, so the pages of the
+pristine state are shared between all processes on the host.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from calc.datasets import (
+    AREA_CASEFILES, CONTACT_MATRIX_CSV_PATH, HEALTHCARE_DISTRICTS_XLS_PATH, POPULATION_CSV_PATH,
+)
+from cythonsim import model
+from utils.data import get_dataset_path
+
+IMAGE_FORMAT_VERSION = 1
+
+IMAGE_ARRAYS = (
+    'people',
+    'people_sorted_by_age',
+    'age_start',
+    'contact_counts',
+    'contact_probabilities',
+    'nr_contacts_by_age',
+)
+
+SOURCE_FILES = [
+    POPULATION_CSV_PATH,
+    HEALTHCARE_DISTRICTS_XLS_PATH,
+    CONTACT_MATRIX_CSV_PATH,
+    model.__file__,
+] + list(AREA_CASEFILES.values())
+
+
+def get_image_dir():
+    return os.path.join(get_dataset_path(), 'population_images')
+
+
+def _get_area_prefix(area_name):
+    return ''.join(c if c.isalnum() else '_' for c in area_name.lower()) + '-'
+
+
+def get_source_mtimes():
+    """Returns the modification times of the source datasets and the engine"""
+
+    mtimes = {}
+    for fn in SOURCE_FILES:
+        try:
+            mtimes[os.path.basename(fn)] = os.path.getmtime(fn)
+        except FileNotFoundError:
+            mtimes[os.path.basename(fn)] = None
+    return mtimes
+
+
+def get_image_path(area_name, key_data):
+    """Returns the directory of the image for the given variables.
+
+    The path changes whenever any of the variables, the source datasets or
+    the engine change, so stale images are never loaded.
+    """
+    data = dict(
+        variables=key_data,
+        mtimes=get_source_mtimes(),
+        version=IMAGE_FORMAT_VERSION,
+        struct_sizes=model.IMAGE_STRUCT_SIZES,
+    )
+    digest = hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    return os.path.join(get_image_dir(), _get_area_prefix(area_name) + digest)
+
+
+def write_image(image, path):
+    """Writes the image returned by `Context.export_image()` atomically to `path`"""
+
+    image_dir = os.path.dirname(path)
+    os.makedirs(image_dir, exist_ok=True)
+
+    tmp_path = tempfile.mkdtemp(dir=image_dir, prefix='.tmp-')
+    try:
+        for name in IMAGE_ARRAYS:
+            np.save(os.path.join(tmp_path, '%s.npy' % name), image[name])
+        with open(os.path.join(tmp_path, 'state.json'), 'w') as f:
+            json.dump(image['state'], f)
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, 'state.json')):
+            raise
+
+
+def remove_stale_images(area_name, current_path):
+    prefix = _get_area_prefix(area_name)
+    image_dir = get_image_dir()
+    for fn in os.listdir(image_dir):
+        path = os.path.join(image_dir, fn)
+        if not fn.startswith(prefix) or path == current_path:
+            continue
+        # Processes that have the image mapped keep their pages.
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def read_image(path):
+    """Maps the image at `path` copy-on-write. Returns None if there is no image."""
+
+    try:
+        with open(os.path.join(path, 'state.json'), 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    image = dict(state=state)
+    for name in IMAGE_ARRAYS:
+        image[name] = np.load(os.path.join(path, '%s.npy' % name), mmap_mode='c')
+    return image
+
+
+if __name__ == '__main__':
+    from calc.simulation import build_population_image
+    from variables import copy_variables
+
+    path = build_population_image(copy_variables())
+    print('Population image written to %s' % path)
@@ -0,0 +1,140 @@
+"""Simulation results of the preset scenarios computed at deploy time.
+
+The results are stored as pickles under `<PRECOMPUTED_RESULTS_PATH>/<version>`
+(by default `<DATASET_PATH>/precomputed`), one file per calcfunc cache key. The version covers the source datasets and
+the engine, so results computed with older inputs are never served. Run
+
+    python -m calc.precomputed_results
+
+after deploying to compute the results of every preset scenario.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+from calc.population_images import get_source_mtimes
+from common import settings
+from utils.data import get_dataset_path
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+
+
+def get_store_root():
+    if settings.PRECOMPUTED_RESULTS_PATH:
+        return settings.PRECOMPUTED_RESULTS_PATH
+    return os.path.join(get_dataset_path(), 'precomputed')
+
+
+def get_data_version():
+    data = dict(mtimes=get_source_mtimes(), version=STORE_FORMAT_VERSION)
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def get_result_path(cache_key, data_version=None):
+    if data_version is None:
+        data_version = get_data_version()
+    fn = '%s.pickle' % hashlib.md5(cache_key.encode()).hexdigest()
+    return os.path.join(get_store_root(), data_version, fn)
+
+
+def read_result(cache_key):
+    """Returns the precomputed result for `cache_key` or None if there is none"""
+
+    try:
+        with open(get_result_path(cache_key), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_result(cache_key, result):
+    path = get_result_path(cache_key)
+    store_dir = os.path.dirname(path)
+    os.makedirs(store_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove_stale_versions():
+    root = get_store_root()
+    current = get_data_version()
+    for fn in os.listdir(root):
+        if fn == current:
+            continue
+        shutil.rmtree(os.path.join(root, fn), ignore_errors=True)
+
+
+def get_presets():
+    """Returns (id, apply) pairs of the preset scenarios.
+
+    `apply` sets the variables of the scenario on top of the defaults.
+    """
+    from scenarios import SCENARIOS
+    from variables import get_variable, reset_variables, set_variable
+
+    def activate(scenario_id):
+        def apply():
+            reset_variables()
+            set_variable('active_scenario', scenario_id)
+        return apply
+
+    presets = [(s['id'], activate(s['id'])) for s in get_variable('scenarios')]
+    presets += [(scenario.id, scenario.apply) for scenario in SCENARIOS]
+    return presets
+
+
+def precompute(seeds, force=False):
+    """Computes and stores the results of every preset scenario for each seed.
+
+    Results that are already stored are skipped unless `force` is set.
+    """
+    from calc.simulation import simulate_individuals
+    from calc.utils import generate_cache_key
+    from variables import allow_set_variable, copy_variables, reset_variables, set_variable
+
+    with allow_set_variable():
+        for preset_id, apply in get_presets():
+            for seed in seeds:
+                apply()
+                if seed is not None:
+                    set_variable('random_seed', seed)
+                variables = copy_variables()
+                cache_key = generate_cache_key(simulate_individuals, var_store=variables)
+                if not force and os.path.exists(get_result_path(cache_key)):
+                    logger.info('%s (seed %s): already computed' % (preset_id, variables['random_seed']))
+                    continue
+
+                start = time.perf_counter()
+                result = simulate_individuals(variable_store=variables, skip_cache=True)
+                write_result(cache_key, result)
+                logger.info('%s (seed %s): computed in %.0f ms' % (
+                    preset_id, variables['random_seed'], (time.perf_counter() - start) * 1000
+                ))
+        reset_variables()
+
+    remove_stale_versions()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the results of the preset scenarios')
+    parser.add_argument('--seeds', type=int, nargs='*', help='random seeds to compute (default: the default seed)')
+    parser.add_argument('--force', action='store_true', help='compute the results again even if stored')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    precompute(args.seeds or [None], force=args.force)
@@ -1,15 +1,20 @@
+import json
 import multiprocessing
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import date, timedelta
 
 import pandas as pd
 import numpy as np
 
-from calc import ExecutionInterrupted, calcfunc
+from calc import ExecutionInterrupted, calcfunc, population_images
 from calc.datasets import (
     get_contacts_for_country, get_initial_population_condition,
     get_population_for_area,
 )
+from calc.utils import generate_cache_key, get_current_variable_store, is_cache_skipped
+from common import cache, settings
 from common.interventions import Intervention, iv_tuple_to_obj, get_active_interventions
 from cythonsim import model
 from utils.perf import PerfCounter
@@ -45,6 +50,31 @@ STATE_ATTRS = [
     'r',
     'mobility_limitation',
 ]
+PHASE_TIMING_ATTRS = ['ms_%s' % phase for phase in model.TIMING_PHASES]
+
+# Variables that affect the state of a context before any interventions
+# are applied.
+TEMPLATE_VARIABLES = list(model.DISEASE_PARAMS) + [
+    'area_name',
+    'country',
+    'max_age',
+    'start_date',
+    'hospital_beds',
+    'icu_units',
+    'random_seed',
+    'imported_infection_ages',
+    'incubating_at_simulation_start',
+    'ill_at_simulation_start',
+    'recovered_at_simulation_start',
+]
+
+# Each context holds a full population, so only a few are kept per process:
+# at most SIMULATION_TEMPLATE_CACHE_SIZE templates and SIMULATION_RESUMABLE_RUNS
+# finished runs.
+_context_templates = OrderedDict()
+# Contexts at the end of finished runs, with the results so far, by run prefix key
+_resumable_runs = OrderedDict()
+_contexts_lock = threading.Lock()
 
 
 def create_disease_params(variables):
@@ -71,33 +101,60 @@ def get_nr_of_contacts():
     return s.sort_index()
 
 
+def _parse_age_range(s):
+    start, end = s.split('-')
+    return int(start), int(end)
+
+
 @calcfunc(funcs=[get_contacts_for_country])
 def get_contacts_per_day():
-    df = get_contacts_for_country()
-    df = pd.melt(
-        df,
-        id_vars=['place_type', 'participant_age'],
-        var_name='contact_age',
-        value_name='contacts'
-    )
-    df['participant_age'] = df['participant_age'].map(
-        lambda x: tuple([int(y) for y in x.split('-')])
+    """Returns the daily contacts by place, participant age and contact age range.
+
+    See expand_contact_matrix() for the format.
+    """
+    return expand_contact_matrix(get_contacts_for_country())
+
+
+def expand_contact_matrix(df):
+    """Expands the contact matrix of get_contacts_for_country() to single participant ages.
+
+    The result is a dict of integer-coded arrays with one element for each
+    (place, participant age, contact age range). The elements are sorted by
+    participant age, then by place name and contact age, which is the order
+    in which the engine builds its contact probabilities.
+    """
+    contact_age_cols = [x for x in df.columns if x not in ('place_type', 'participant_age')]
+    contact_ranges = np.array([_parse_age_range(x) for x in contact_age_cols], dtype=np.int32)
+
+    str_to_place = {val: key for key, val in model.CONTACT_PLACE_TO_STR.items()}
+    place_codes = df['place_type'].map(str_to_place).values.astype(np.int32)
+    participant_ranges = np.array([_parse_age_range(x) for x in df['participant_age']], dtype=np.int32)
+    participant_ranges = participant_ranges.reshape(-1, 2)
+    values = df[contact_age_cols].values.astype(np.double)
+
+    # Expand each row to one row per participant age in its range
+    spans = participant_ranges[:, 1] - participant_ranges[:, 0] + 1
+    row_idx = np.repeat(np.arange(len(df)), spans)
+    offsets = np.arange(len(row_idx)) - np.repeat(np.cumsum(spans) - spans, spans)
+    participant_ages = participant_ranges[row_idx, 0] + offsets
+
+    # ...and then to one row per contact age range
+    nr_ranges = len(contact_age_cols)
+    out = dict(
+        place=np.repeat(place_codes[row_idx], nr_ranges),
+        participant_age=np.repeat(participant_ages, nr_ranges).astype(np.int32),
+        contact_age_min=np.tile(contact_ranges[:, 0], len(row_idx)),
+        contact_age_max=np.tile(contact_ranges[:, 1], len(row_idx)),
+        contacts=values[row_idx].ravel(),
     )
-    df['contact_age'] = df['contact_age'].map(lambda x: tuple([int(y) for y in x.split('-')]))
-
-    df = pd.DataFrame(
-        [
-            (t.place_type, p, t.contact_age, t.contacts) for t in df.itertuples()
-            for p in range(t.participant_age[0], t.participant_age[1] + 1)
-        ],
-        columns=['place_type', 'participant_age', 'contact_age', 'contacts']
-    )
-    # df = pd.DataFrame(
-    #    [(t.place_type, t.participant_age, c, t.contacts / (t.contact_age[1] - t.contact_age[0] + 1)) for t in df.itertuples() for c in range(t.contact_age[0], t.contact_age[1] + 1)],
-    #    columns=['place_type', 'participant_age', 'contact_age', 'contacts']
-    # )
 
-    return df
+    place_names = sorted(str_to_place.keys())
+    place_rank = np.zeros(max(str_to_place.values()) + 1, dtype=np.int32)
+    for rank, name in enumerate(place_names):
+        place_rank[str_to_place[name]] = rank
+    order = np.lexsort((out['contact_age_min'], place_rank[out['place']], out['participant_age']))
+
+    return {key: np.ascontiguousarray(arr[order]) for key, arr in out.items()}
 
 
 @calcfunc(
@@ -128,32 +185,17 @@ def get_age_grouped_population():
     return df
 
 
-@calcfunc(
-    variables=list(model.DISEASE_PARAMS) + [
-        'simulation_days',
-        'interventions',
-        'active_scenario',
-        'scenarios',
-        'start_date',
-        'hospital_beds',
-        'icu_units',
-        'random_seed',
-        'max_age',
-        'imported_infection_ages',
-    ],
-    funcs=[get_contacts_per_day, get_population_for_area],
-    filedeps=[model.__file__],
-)
-def simulate_individuals(variables, step_callback=None, callback_day_interval=1):
-    pc = PerfCounter()
-
-    age_structure = get_population_for_area().sum(axis=1)
-    ipc = get_initial_population_condition()
+def create_population_params(variables, age_structure=None):
+    if age_structure is None:
+        age_structure = get_population_for_area().sum(axis=1)
+        ipc = get_initial_population_condition()
+    else:
+        ipc = None
 
     age_to_group = make_age_groups()
 
     age_groups = list(np.unique(age_to_group))
-    pop_params = dict(
+    return dict(
         age_structure=age_structure,
         contacts_per_day=get_contacts_per_day(),
         initial_population_condition=ipc,
@@ -161,36 +203,243 @@ def simulate_individuals(variables, step_callback=None, callback_day_interval=1)
         imported_infection_ages=variables['imported_infection_ages'],
     )
 
-    df = get_contacts_per_day()
 
+def _build_context(variables, age_structure=None, image=None):
+    pop_params = create_population_params(variables, age_structure)
     hc_params = dict(hospital_beds=variables['hospital_beds'], icu_units=variables['icu_units'])
     disease_params = create_disease_params(variables)
-    context = model.Context(
+    return model.Context(
         population_params=pop_params,
         healthcare_params=hc_params,
         disease_params=disease_params,
         start_date=variables['start_date'],
-        random_seed=variables['random_seed']
+        random_seed=variables['random_seed'],
+        collect_timings=settings.SIMULATION_PHASE_TIMINGS,
+        image=image,
     )
-    start_date = date.fromisoformat(variables['start_date'])
+
+
+def _get_template_key_data(variables):
+    key_data = {x: variables[x] for x in TEMPLATE_VARIABLES}
+    key_data['collect_timings'] = settings.SIMULATION_PHASE_TIMINGS
+    return key_data
+
+
+def build_population_image(variables):
+    """Writes the pristine area population for `variables` as an image.
+
+    Returns the path of the image.
+    """
+    context = _build_context(variables)
+    path = population_images.get_image_path(variables['area_name'], _get_template_key_data(variables))
+    population_images.write_image(context.export_image(), path)
+    population_images.remove_stale_images(variables['area_name'], path)
+    return path
+
+
+def _load_context_from_image(variables):
+    path = population_images.get_image_path(variables['area_name'], _get_template_key_data(variables))
+    image = population_images.read_image(path)
+    if image is None:
+        return None
+    return _build_context(variables, image=image)
+
+
+def _get_context_template(variables):
+    """Returns a pristine context for the area population, building it only if needed.
+
+    The most recently used templates are kept in the process, so that
+    repeated runs with different interventions only need to clone one.
+    """
+    key = json.dumps(_get_template_key_data(variables), sort_keys=True)
+
+    with _contexts_lock:
+        template = _context_templates.get(key)
+        if template is not None:
+            _context_templates.move_to_end(key)
+            return template
+
+    template = _build_context(variables)
+    with _contexts_lock:
+        _context_templates[key] = template
+        while len(_context_templates) > settings.SIMULATION_TEMPLATE_CACHE_SIZE:
+            _context_templates.popitem(last=False)
+
+    return template
+
+
+def prepare_context(variables):
+    """Makes the pristine context of the area ready for create_context().
+
+    If there is a population image, it is mapped once so that its pages are
+    in the page cache. Otherwise the context template is built and kept in
+    this process, where forked children inherit it.
+    """
+    if _load_context_from_image(variables) is not None:
+        return
+    if settings.SIMULATION_TEMPLATE_CACHE_SIZE > 0:
+        _get_context_template(variables)
+
+
+def create_context(variables, age_structure=None):
+    """Creates a simulation context with the active interventions scheduled.
+
+    By default the population of the configured area is used, along with its
+    initial epidemic condition. A custom `age_structure` (a Series of counts
+    indexed by age) starts from a fully susceptible population instead.
+    """
+    context = None
+    if age_structure is None:
+        # Prefer a prebuilt image shared by all processes, then a template
+        # kept in this process.
+        context = _load_context_from_image(variables)
+        if context is None and settings.SIMULATION_TEMPLATE_CACHE_SIZE > 0:
+            context = _get_context_template(variables).clone()
+    if context is None:
+        context = _build_context(variables, age_structure)
 
     ivs = get_active_interventions(variables)
     for iv in ivs:
         context.add_intervention(iv)
 
-    pc.measure()
+    return context
+
+
+@calcfunc(
+    variables=list(model.DISEASE_PARAMS) + [
+        'simulation_days',
+        'interventions',
+        'active_scenario',
+        'scenarios',
+        'start_date',
+        'hospital_beds',
+        'icu_units',
+        'random_seed',
+        'max_age',
+        'imported_infection_ages',
+        # Read by create_context() through TEMPLATE_VARIABLES
+        'area_name',
+        'country',
+        'incubating_at_simulation_start',
+        'ill_at_simulation_start',
+        'recovered_at_simulation_start',
+    ],
+    funcs=[get_contacts_per_day, get_population_for_area, get_initial_population_condition, make_age_groups],
+    filedeps=[model.__file__],
+    precomputed=True,
+)
+def simulate_individuals(variables, step_callback=None, callback_day_interval=1):
+    if is_cache_skipped():
+        # A fresh run is requested, so no earlier run is reused
+        context = create_context(variables)
+        df, ag_array = _run_context(context, variables, step_callback, callback_day_interval)
+        return df, make_age_group_df(ag_array, df.index)
+
+    days = variables['simulation_days']
+    prefix_key = get_run_prefix_key(get_current_variable_store())
+
+    # Runs that differ only by their length are identical up to the shorter one
+    prefix = cache.get(prefix_key)
+    if prefix is not None and prefix['days'] >= days:
+        return prefix['total'].iloc[:days].copy(), prefix['age_groups'].iloc[:days].copy()
+
+    with _contexts_lock:
+        resumable = _resumable_runs.get(prefix_key)
+        if resumable is not None and resumable[0] < days:
+            # The context continues from where the previous run left it, so
+            # no other run may use it anymore
+            del _resumable_runs[prefix_key]
+
+    if resumable is not None and resumable[0] >= days:
+        prev_df, prev_ag_array = resumable[2]
+        df = prev_df.iloc[:days].copy()
+        return df, make_age_group_df(prev_ag_array[:days], df.index)
+
+    if resumable is not None:
+        _, context, resume_from = resumable
+    else:
+        context = create_context(variables)
+        resume_from = None
+
+    df, ag_array = _run_context(context, variables, step_callback, callback_day_interval, resume_from)
+    adf = make_age_group_df(ag_array, df.index)
+
+    if prefix is None or prefix['days'] < days:
+        cache.set(prefix_key, dict(days=days, total=df, age_groups=adf), timeout=3600)
+    if settings.SIMULATION_RESUMABLE_RUNS > 0:
+        with _contexts_lock:
+            _resumable_runs[prefix_key] = (days, context, (df, ag_array))
+            while len(_resumable_runs) > settings.SIMULATION_RESUMABLE_RUNS:
+                _resumable_runs.popitem(last=False)
+
+    return df, adf
+
+
+def get_run_prefix_key(var_store):
+    """Returns the key shared by the runs that differ only by `simulation_days`.
+
+    The key covers the variables of every calcfunc the run depends on, read
+    from `var_store` (or the session if None).
+    """
+    key = generate_cache_key(simulate_individuals, var_store=var_store, exclude_variables=['simulation_days'])
+    return '%s-prefix' % key
+
+
+def run_context(context, variables, step_callback=None, callback_day_interval=1):
+    """Runs the simulation for `simulation_days` and returns the daily totals
+    and the daily values by age group."""
+
+    df, ag_array = _run_context(context, variables, step_callback, callback_day_interval)
+    return df, make_age_group_df(ag_array, df.index)
+
+
+def make_age_group_df(ag_array, date_index):
+    age_groups = list(np.unique(make_age_groups()))
+    arr = ag_array.flatten()
+    adf = pd.DataFrame(
+        arr,
+        index=pd.MultiIndex.from_product(
+            [date_index, POP_ATTRS, age_groups],
+            names=['date', 'attr', 'age_group']
+        ),
+        columns=['pop']
+    )
+    adf = adf.unstack('attr').unstack('age_group')
+    adf.columns = adf.columns.droplevel()
+    return adf
+
+
+def _run_context(context, variables, step_callback=None, callback_day_interval=1, resume_from=None):
+    """Runs the context up to `simulation_days` and returns the daily totals
+    and the array of daily values by age group.
+
+    `resume_from` holds the results of a run that left the context at its
+    last day. The run then continues from the day after it.
+    """
+    pc = PerfCounter()
+
+    age_groups = list(np.unique(make_age_groups()))
+    start_date = date.fromisoformat(variables['start_date'])
+    collect_timings = context.collect_timings
 
     days = variables['simulation_days']
 
     date_index = pd.date_range(start_date, periods=days)
-    df = pd.DataFrame(
-        columns=POP_ATTRS + STATE_ATTRS + EXPOSURES_ATTRS + ['us_per_infected'],
-        index=date_index,
-    )
+    columns = POP_ATTRS + STATE_ATTRS + EXPOSURES_ATTRS + ['us_per_infected']
+    if collect_timings:
+        columns += PHASE_TIMING_ATTRS
 
     ag_array = np.empty((days, len(POP_ATTRS), len(age_groups)), dtype='i')
+    if resume_from is None:
+        first_day = 0
+        df = pd.DataFrame(columns=columns, index=date_index)
+    else:
+        prev_df, prev_ag_array = resume_from
+        first_day = len(prev_df)
+        df = prev_df.reindex(index=date_index, columns=columns)
+        ag_array[:first_day] = prev_ag_array
 
-    for day in range(days):
+    for day in range(first_day, days):
         s = context.generate_state()
 
         today_date = (start_date + timedelta(days=day)).isoformat()
@@ -210,6 +459,11 @@ def simulate_individuals(variables, step_callback=None, callback_day_interval=1)
 
         rec['us_per_infected'] = pc.measure() * 1000 / rec['infected'] if rec['infected'] else 0
 
+        if collect_timings:
+            # Timings of the iteration that produced today's state
+            for phase, ms in s['phase_timings'].items():
+                rec['ms_%s' % phase] = ms
+
         if False:
             st = '\n%-15s' % today_date
             for ag in age_groups:
@@ -268,19 +522,7 @@ def simulate_individuals(variables, step_callback=None, callback_day_interval=1)
             s = pstats.Stats("profile.prof")
             s.strip_dirs().sort_stats("cumtime").print_stats()
 
-    arr = ag_array.flatten()
-    adf = pd.DataFrame(
-        arr,
-        index=pd.MultiIndex.from_product(
-            [date_index, POP_ATTRS, age_groups],
-            names=['date', 'attr', 'age_group']
-        ),
-        columns=['pop']
-    )
-    adf = adf.unstack('attr').unstack('age_group')
-    adf.columns = adf.columns.droplevel()
-
-    return df, adf
+    return df, ag_array
 
 
 @calcfunc(
@@ -1,15 +1,52 @@
 import hashlib
 import importlib
+import inspect
 import json
+import logging
 import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
 
-from common import cache
+from common import cache, cache_stats, settings
 from utils.perf import PerfCounter
-from variables import get_variable
+from variables import get_variable, get_variable_version
 
 _dataset_cache = {}
 
+# Per-process memos for generating the cache keys
+_func_deps = {}
+_func_hashes = {}
+_filedep_mtimes = {}
+_variable_digests = {}
+MAX_VARIABLE_DIGESTS = 10000
+
+# Previous values of stale-while-revalidate calcfuncs are kept this long
+STALE_TIMEOUT = 7 * 24 * 3600
+REFRESH_CLAIM_TIMEOUT = 300
+
+_refresh_executor = None
+_refresh_executor_pid = None
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
+_prefetch_executor = None
+_prefetch_executor_pid = None
+_prefetchable_funcs = {}
+
+# Events of the values being computed in this process by cache key
+_inflight = {}
+_inflight_pid = None
+_inflight_lock = threading.Lock()
+
+# The variable store, the nesting depth and the skip_cache flag of the
+# calcfunc being evaluated in the current thread
+_eval_state = threading.local()
+
+logger = logging.getLogger(__name__)
+
 
 def ensure_imported(func):
     if isinstance(func, str):
@@ -45,34 +82,312 @@ def _get_func_hash_data(func, seen_funcs):
     return dict(variables=all_variables, funcs=all_funcs)
 
 
-def _hash_funcs(funcs):
+def _get_func_deps(func):
+    """Returns the dependency closure of `func`, computed once per process"""
+
+    deps = _func_deps.get(func)
+    if deps is not None:
+        return deps
+
+    hash_data = _get_func_hash_data(func, None)
+    funcs = sorted(hash_data['funcs'], key=lambda f: (f.__module__, f.__qualname__))
     m = hashlib.md5()
+    filedeps = set()
     for f in funcs:
-        m.update(f.__code__.co_code)
-        if f.filedeps:
-            for fn in f.filedeps:
-                try:
-                    update_time = os.path.getmtime(fn)
-                except FileNotFoundError:
-                    update_time = None
-                m.update(bytes(str(update_time), encoding='ascii'))
-    return m.hexdigest()
+        # Hash the wrapped function instead of the calcfunc wrapper
+        m.update(getattr(f, '__wrapped__', f).__code__.co_code)
+        filedeps.update(f.filedeps or [])
+
+    deps = dict(
+        variables=sorted(hash_data['variables']),
+        code_hash=m.hexdigest(),
+        filedeps=sorted(filedeps),
+        name='.'.join((func.__module__, func.__name__)),
+    )
+    _func_deps[func] = deps
+    return deps
+
+
+def get_filedep_mtime(fn):
+    """Returns the mtime of `fn`, checking it at most once per CALCFUNC_FILEDEP_CHECK_INTERVAL"""
+
+    now = time.monotonic()
+    entry = _filedep_mtimes.get(fn)
+    if entry is None or now - entry[1] >= settings.CALCFUNC_FILEDEP_CHECK_INTERVAL:
+        try:
+            update_time = os.path.getmtime(fn)
+        except FileNotFoundError:
+            update_time = None
+        entry = (update_time, now)
+        _filedep_mtimes[fn] = entry
+    return entry[0]
+
+
+def _get_func_hash(func, deps):
+    mtimes = tuple(get_filedep_mtime(fn) for fn in deps['filedeps'])
+    cached = _func_hashes.get(func)
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+
+    m = hashlib.md5(deps['code_hash'].encode())
+    m.update(bytes(str(mtimes), encoding='ascii'))
+    func_hash = m.hexdigest()
+    _func_hashes[func] = (mtimes, func_hash)
+    return func_hash
+
+
+class _VariableSnapshot(dict):
+    """Variable values resolved for use outside of the current context.
+
+    Keeps the versions of the variables, so that their digests are still
+    found from the memo."""
+
+    def __init__(self, values, versions):
+        super().__init__(values)
+        self.versions = versions
+
+
+def _snapshot_variables(func, var_store):
+    var_names = _get_func_deps(func)['variables']
+    values = {x: get_variable(x, var_store=var_store) for x in var_names}
+    if var_store is None:
+        versions = {x: get_variable_version(x) for x in var_names}
+    elif isinstance(var_store, _VariableSnapshot):
+        versions = {x: var_store.versions.get(x) for x in var_names}
+    else:
+        versions = {}
+    return _VariableSnapshot(values, versions)
+
+
+def _get_variable_digest(var_name, var_store):
+    version = None
+    if var_store is None:
+        version = get_variable_version(var_name)
+    elif isinstance(var_store, _VariableSnapshot):
+        version = var_store.versions.get(var_name)
+    if version is not None:
+        digest = _variable_digests.get((var_name, version))
+        if digest is not None:
+            return digest
+
+    val = get_variable(var_name, var_store=var_store)
+    digest = hashlib.md5(json.dumps(val, sort_keys=True).encode()).hexdigest()
+    if version is not None:
+        if len(_variable_digests) >= MAX_VARIABLE_DIGESTS:
+            _variable_digests.clear()
+        _variable_digests[(var_name, version)] = digest
+    return digest
+
+
+def generate_cache_key(func, var_store=None, exclude_variables=None):
+    deps = _get_func_deps(func)
+
+    # Only the variables that have changed since the previous call are hashed
+    # again, the digests of the rest are found by their variable versions.
+    m = hashlib.md5()
+    for var_name in deps['variables']:
+        if exclude_variables and var_name in exclude_variables:
+            continue
+        m.update(('%s=%s;' % (var_name, _get_variable_digest(var_name, var_store))).encode())
 
+    func_hash = _get_func_hash(func, deps)
 
-def generate_cache_key(func, var_store=None):
-    hash_data = _get_func_hash_data(func, None)
+    return '%s:%s:%s' % (deps['name'], m.hexdigest(), func_hash)
+
+
+def get_current_variable_store():
+    """Returns the variable store of the calcfunc being evaluated, or None if it uses the session"""
 
-    funcs = hash_data['funcs']
-    variables = hash_data['variables']
-    var_data = json.dumps({x: get_variable(x, var_store=var_store) for x in variables}, sort_keys=True)
+    return getattr(_eval_state, 'var_store', None)
 
-    func_hash = _hash_funcs(funcs)
-    func_name = '.'.join((func.__module__, func.__name__))
 
-    return '%s:%s:%s' % (func_name, hashlib.md5(var_data.encode()).hexdigest(), func_hash)
+def is_cache_skipped():
+    """Returns True if the calcfunc being evaluated was called with `skip_cache`"""
 
+    return getattr(_eval_state, 'skip_cache', False)
 
-def calcfunc(variables=None, datasets=None, funcs=None, filedeps=None):
+
+def _get_stale_key(func, cache_key):
+    # Drop the mtimes of the file dependencies but keep the hash of the code,
+    # so values computed by older code are never served.
+    return '%s:%s-stale' % (cache_key.rsplit(':', 1)[0], _get_func_deps(func)['code_hash'])
+
+
+def _get_refresh_executor():
+    global _refresh_executor, _refresh_executor_pid
+
+    # The threads of an executor created before a fork do not exist in the child
+    if _refresh_executor is None or _refresh_executor_pid != os.getpid():
+        _refresh_executor = ThreadPoolExecutor(max_workers=settings.CALCFUNC_REFRESH_WORKERS)
+        _refresh_executor_pid = os.getpid()
+        _refreshing.clear()
+    return _refresh_executor
+
+
+def _refresh(calc_func, cache_key, owner, var_store):
+    try:
+        calc_func(variable_store=var_store, skip_stale=True)
+    except Exception:
+        logger.exception('Refreshing %s failed' % cache_key)
+    finally:
+        cache.release_claim('%s-refresh' % cache_key, owner)
+        with _refresh_lock:
+            _refreshing.discard(cache_key)
+
+
+def _schedule_refresh(calc_func, cache_key, var_store):
+    """Recomputes `cache_key` in the background unless it is already being recomputed"""
+
+    executor = _get_refresh_executor()
+    with _refresh_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+
+    # Only one process recomputes the value
+    claimed, owner = cache.claim('%s-refresh' % cache_key, REFRESH_CLAIM_TIMEOUT)
+    if not claimed:
+        with _refresh_lock:
+            _refreshing.discard(cache_key)
+        return
+
+    executor.submit(_refresh, calc_func, cache_key, owner, var_store)
+
+
+def get_dependency_graph(func):
+    """Returns the declared calcfunc dependencies of `func` as a DAG.
+
+    The result maps `func` and every calcfunc it depends on, directly or
+    through other calcfuncs, to the list of calcfuncs it depends on directly.
+    """
+    graph = {}
+    stack = [func]
+    while stack:
+        f = stack.pop()
+        if f in graph:
+            continue
+        children = [ensure_imported(x) for x in f.calcfuncs or []]
+        graph[f] = children
+        stack.extend(children)
+    return graph
+
+
+def _is_prefetchable(func):
+    """Returns True if `func` can be called without arguments"""
+
+    ret = _prefetchable_funcs.get(func)
+    if ret is None:
+        params = inspect.signature(func.__wrapped__).parameters.values()
+        ret = all(
+            p.name in ('variables', 'datasets') or p.default is not p.empty
+            or p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+            for p in params
+        )
+        _prefetchable_funcs[func] = ret
+    return ret
+
+
+def _get_prefetch_executor():
+    global _prefetch_executor, _prefetch_executor_pid
+
+    if _prefetch_executor is None or _prefetch_executor_pid != os.getpid():
+        _prefetch_executor = ThreadPoolExecutor(max_workers=settings.CALCFUNC_PREFETCH_WORKERS)
+        _prefetch_executor_pid = os.getpid()
+    return _prefetch_executor
+
+
+def _prefetch(calc_func, var_store):
+    _eval_state.depth = 1
+    try:
+        calc_func(variable_store=var_store)
+    except Exception as e:
+        # The caller computes the value again and gets the exception
+        logger.warning('Prefetching %s failed: %s' % (calc_func.__name__, e))
+    finally:
+        _eval_state.depth = 0
+
+
+def prefetch_dependencies(calc_func, var_store):
+    """Computes the dependencies of `calc_func` that are not cached concurrently.
+
+    The dependencies are computed in waves from the leaves of the graph up,
+    so that each one runs once its own dependencies are in the cache.
+    Dependencies of cached calcfuncs are not computed.
+    """
+    graph = get_dependency_graph(calc_func)
+    cold = set()
+    seen = set()
+    stack = list(graph[calc_func])
+    while stack:
+        f = stack.pop()
+        if f in seen:
+            continue
+        seen.add(f)
+        if not _is_prefetchable(f):
+            continue
+        if f(variable_store=var_store, only_if_in_cache=True) is not None:
+            continue
+        cold.add(f)
+        stack.extend(graph[f])
+
+    if len(cold) < 2:
+        # Nothing to run concurrently
+        return
+
+    heights = {}
+
+    def get_height(f):
+        if f not in heights:
+            heights[f] = max([get_height(c) + 1 for c in graph[f] if c in cold], default=0)
+        return heights[f]
+
+    waves = defaultdict(list)
+    for f in cold:
+        waves[get_height(f)].append(f)
+
+    executor = _get_prefetch_executor()
+    for height in sorted(waves.keys()):
+        wait([executor.submit(_prefetch, f, var_store) for f in waves[height]])
+
+
+def _begin_compute(cache_key):
+    """Marks `cache_key` as being computed by the caller.
+
+    Returns None if the caller should compute the value, or an event that is
+    set when another thread has finished computing it.
+    """
+    global _inflight_pid
+
+    with _inflight_lock:
+        # The threads of the parent do not exist after a fork
+        if _inflight_pid != os.getpid():
+            _inflight.clear()
+            _inflight_pid = os.getpid()
+        event = _inflight.get(cache_key)
+        if event is not None:
+            return event
+        _inflight[cache_key] = threading.Event()
+    return None
+
+
+def _end_compute(cache_key):
+    with _inflight_lock:
+        _inflight.pop(cache_key).set()
+
+
+def calcfunc(
+    variables=None, datasets=None, funcs=None, filedeps=None, stale_while_revalidate=False, precomputed=False
+):
+    """Makes the decorated function cached by its variables, datasets, calcfuncs and file dependencies.
+
+    With `stale_while_revalidate`, a call whose result has been invalidated
+    by a change in the file dependencies returns the previous result, while
+    the new one is computed in the background. A change in the code always
+    invalidates the previous result.
+
+    With `precomputed`, a cache miss is looked up from the results computed
+    at deploy time (see calc.precomputed_results) before computing it.
+    """
     if datasets is not None:
         assert isinstance(datasets, (list, tuple, dict))
         if not isinstance(datasets, dict):
@@ -102,6 +417,7 @@ def calcfunc(variables=None, datasets=None, funcs=None, filedeps=None):
         func.datasets = datasets
         func.calcfuncs = funcs
         func.filedeps = filedeps
+        func_name = '%s.%s' % (func.__module__, func.__name__)
 
         @wraps(func)
         def wrap_calc_func(*args, **kwargs):
@@ -109,14 +425,18 @@ def calcfunc(variables=None, datasets=None, funcs=None, filedeps=None):
 
             only_if_in_cache = kwargs.pop('only_if_in_cache', False)
             skip_cache = kwargs.pop('skip_cache', False)
+            skip_stale = kwargs.pop('skip_stale', False)
             var_store = kwargs.pop('variable_store', None)
+            if var_store is None:
+                # Nested calls use the variables of the calcfunc that called them
+                var_store = getattr(_eval_state, 'var_store', None)
 
             if filedeps:
                 for filedep in filedeps:
-                    assert os.path.getmtime(filedep)
+                    assert get_filedep_mtime(filedep)
 
             if should_profile:
-                pc = PerfCounter('%s.%s' % (func.__module__, func.__name__))
+                pc = PerfCounter(func_name)
                 pc.display('enter')
 
             cache_key = generate_cache_key(func, var_store=var_store)
@@ -133,44 +453,105 @@ def calcfunc(variables=None, datasets=None, funcs=None, filedeps=None):
             if should_cache_func:
                 ret = cache.get(cache_key)
                 if ret is not None:  # calcfuncs must not return None
+                    cache_stats.incr(func_name, 'hits')
                     if should_profile:
                         pc.display('cache hit (%s)' % cache_key)
                     return ret
+                if precomputed:
+                    from calc.precomputed_results import read_result
+
+                    ret = read_result(cache_key)
+                    if ret is not None:
+                        cache_stats.incr(func_name, 'precomputed_hits')
+                        cache.set(cache_key, ret, timeout=3600, local_timeout=3600)
+                        if should_profile:
+                            pc.display('precomputed hit (%s)' % cache_key)
+                        return ret
                 if only_if_in_cache:
+                    cache_stats.incr(func_name, 'only_if_in_cache_misses')
                     if should_profile:
                         pc.display('cache miss so leaving as requested (%s)' % cache_key)
                     return None
-
-            if variables is not None:
-                kwargs['variables'] = {x: get_variable(y, var_store=var_store) for x, y in variables.items()}
-
-            if datasets is not None:
-                datasets_to_load = set(list(datasets.values())) - set(_dataset_cache.keys())
-                if datasets_to_load:
-                    loaded_datasets = []
-                    for dataset_name in datasets_to_load:
-                        if should_profile:
-                            ds_pc = PerfCounter('dataset %s' % dataset_name)
-                        df = load_datasets(dataset_name)
+                if stale_while_revalidate and not skip_stale:
+                    ret = cache.get(_get_stale_key(func, cache_key))
+                    if ret is not None:
+                        cache_stats.incr(func_name, 'stale_hits')
+                        # Resolve the variables now, as the refresh runs outside of this request
+                        var_store = _snapshot_variables(func, var_store)
+                        _schedule_refresh(wrap_calc_func, cache_key, var_store)
                         if should_profile:
-                            ds_pc.display('loaded')
-                            del ds_pc
-                        loaded_datasets.append(df)
-
-                    for dataset_name, dataset in zip(datasets_to_load, loaded_datasets):
-                        _dataset_cache[dataset_name] = dataset
-
-                kwargs['datasets'] = {ds_name: _dataset_cache[ds_url] for ds_name, ds_url in datasets.items()}
-
-            ret = func(*args, **kwargs)
-
-            if should_profile:
-                pc.display('func ret')
-            if should_cache_func:
-                assert ret is not None
-                cache.set(cache_key, ret, timeout=3600)
-
-            return ret
+                            pc.display('stale hit, refreshing (%s)' % cache_key)
+                        return ret
+                cache_stats.incr(func_name, 'misses')
+
+                # Only one thread computes the same value at a time
+                while True:
+                    event = _begin_compute(cache_key)
+                    if event is None:
+                        break
+                    event.wait()
+                    ret = cache.get(cache_key)
+                    if ret is not None:
+                        cache_stats.incr(func_name, 'deduplicated_calls')
+                        return ret
+            else:
+                cache_stats.incr(func_name, 'uncached_calls')
+
+            try:
+                depth = getattr(_eval_state, 'depth', 0)
+                if funcs and not depth and settings.CALCFUNC_PREFETCH_WORKERS > 0:
+                    # Resolve the variables now, as the dependencies are computed in other threads
+                    var_store = _snapshot_variables(func, var_store)
+                    prefetch_dependencies(wrap_calc_func, var_store)
+
+                if variables is not None:
+                    kwargs['variables'] = {x: get_variable(y, var_store=var_store) for x, y in variables.items()}
+
+                if datasets is not None:
+                    datasets_to_load = set(list(datasets.values())) - set(_dataset_cache.keys())
+                    if datasets_to_load:
+                        loaded_datasets = []
+                        for dataset_name in datasets_to_load:
+                            if should_profile:
+                                ds_pc = PerfCounter('dataset %s' % dataset_name)
+                            df = load_datasets(dataset_name)
+                            if should_profile:
+                                ds_pc.display('loaded')
+                                del ds_pc
+                            loaded_datasets.append(df)
+
+                        for dataset_name, dataset in zip(datasets_to_load, loaded_datasets):
+                            _dataset_cache[dataset_name] = dataset
+
+                    kwargs['datasets'] = {ds_name: _dataset_cache[ds_url] for ds_name, ds_url in datasets.items()}
+
+                outer_var_store = getattr(_eval_state, 'var_store', None)
+                outer_skip_cache = getattr(_eval_state, 'skip_cache', False)
+                _eval_state.var_store = var_store
+                _eval_state.skip_cache = skip_cache
+                _eval_state.depth = depth + 1
+                start = time.perf_counter()
+                try:
+                    ret = func(*args, **kwargs)
+                finally:
+                    _eval_state.var_store = outer_var_store
+                    _eval_state.skip_cache = outer_skip_cache
+                    _eval_state.depth = depth
+                cache_stats.observe(func_name, 'compute_ms', (time.perf_counter() - start) * 1000)
+
+                if should_profile:
+                    pc.display('func ret')
+                if should_cache_func:
+                    assert ret is not None
+                    # The key covers all the inputs, so the local copy never goes stale
+                    cache.set(cache_key, ret, timeout=3600, local_timeout=3600)
+                    if stale_while_revalidate:
+                        cache.set(_get_stale_key(func, cache_key), ret, timeout=STALE_TIMEOUT)
+
+                return ret
+            finally:
+                if should_cache_func:
+                    _end_compute(cache_key)
 
         return wrap_calc_func
 
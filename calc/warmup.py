@@ -0,0 +1,65 @@
+"""Evaluates the calcfuncs that depend only on the configured area.
+
+Run in the server master process before the workers are forked, so that
+the server workers share the loaded datasets copy-on-write and serve their
+first request without loading them. The simulation workers are started by
+a fork server that does not inherit the master's memory, so they warm up
+on their own when they start.
+"""
+import logging
+import time
+
+from calc.datasets import (
+    get_detected_cases, get_initial_population_condition, get_mobility_data, get_population_for_area,
+)
+from calc.metric_values import get_mobility_change_values, get_validation_values
+from calc.simulation import (
+    get_age_grouped_population, get_contacts_per_day, get_nr_of_contacts, make_age_groups, prepare_context,
+)
+from variables import copy_variables
+
+logger = logging.getLogger(__name__)
+
+WARMUP_FUNCS = [
+    get_population_for_area,
+    get_contacts_per_day,
+    get_nr_of_contacts,
+    make_age_groups,
+    get_age_grouped_population,
+    get_detected_cases,
+    get_initial_population_condition,
+    get_mobility_data,
+    get_validation_values,
+    get_mobility_change_values,
+]
+
+
+def warm_up(with_context=True):
+    """Loads the static datasets and optionally prepares the engine state.
+
+    With `with_context`, the pristine simulation context of the area is
+    prepared as well (see `prepare_context()`), so that runs only need to
+    clone it. Returns the time taken in milliseconds.
+    """
+    start = time.perf_counter()
+    for func in WARMUP_FUNCS:
+        func_start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            # The server must start even without the optional datasets
+            logger.warning('Warmup of %s failed: %s' % (func.__name__, e))
+            continue
+        logger.info('Warmed up %s in %.0f ms' % (func.__name__, (time.perf_counter() - func_start) * 1000))
+
+    if with_context:
+        prepare_context(copy_variables())
+
+    ms = (time.perf_counter() - start) * 1000
+    logger.info('Warmup took %.0f ms' % ms)
+    return ms
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    warm_up()
@@ -1,48 +1,652 @@
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
 from flask_caching import Cache
 
+from common import cache_serialization, cache_stats
 
+_initialized = False
 _cache_backend = None
+_redis_client = None
+_key_prefix = ''
+_local_cache = None
+_compression = None
+_compress_min_bytes = 0
+# Claims by key as (owner, expiry time), when there is no Redis. They are
+# kept apart from the LRU, so that large values never evict them.
+_local_claims = {}
+_claim_lock = threading.Lock()
+# Records by key as (fields, expiry time), when there is no Redis. Like
+# the claims, they are never evicted to make room for values.
+_local_records = {}
+_record_lock = threading.Lock()
+
+# Notifications of the channels subscribed to in this process, when there
+# is no Redis to pass them between processes
+_local_channels = threading.Condition()
+_local_channel_seqs = {}
+_local_channel_subscribers = {}
+
+# Priority queues by name, when there is no Redis
+_local_queues = {}
+_queue_lock = threading.Lock()
+
+# Sets by key as (members, expiry time), when there is no Redis
+_local_sets = {}
+_set_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300
+VERSION_SUFFIX = ':version'
+
+# Sets the claim if it is free or already held by the caller.
+# Returns the holder of the claim.
+CLAIM_SCRIPT = '''
+local current = redis.call('get', KEYS[1])
+if not current or current == ARGV[1] then
+    redis.call('set', KEYS[1], ARGV[1], 'px', ARGV[2])
+    return ARGV[1]
+end
+return current
+'''
+
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+def estimate_size(obj):
+    """Returns a rough estimate of the memory used by `obj` in bytes"""
+
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(x) for x in obj)
+    return sys.getsizeof(obj)
+
+
+def copy_value(obj):
+    """Returns a copy of `obj` that the caller may modify without affecting the cached value.
+
+    Frames, series and arrays are copied along with the containers holding
+    them. Other values are treated as immutable.
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: copy_value(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [copy_value(x) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(copy_value(x) for x in obj)
+    return obj
+
+
+class LocalEntry:
+    __slots__ = ('value', 'version', 'size', 'expires_at', 'trusted_until', 'local_timeout')
+
+    def __init__(self, value, version, size, expires_at, local_timeout, now):
+        self.value = value
+        self.version = version
+        self.size = size
+        self.expires_at = expires_at
+        self.local_timeout = local_timeout
+        self.trusted_until = now + local_timeout
+
+
+class LocalCache:
+    """A per-process LRU of decoded objects bounded by their estimated size.
+
+    The entries are owned by the cache: callers store and get copies of them.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nr_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at is not None and now >= entry.expires_at:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, version, timeout, local_timeout, now):
+        """Stores the value and returns its estimated size"""
+        size = estimate_size(value)
+        expires_at = now + timeout if timeout else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return size
+            self.entries[key] = LocalEntry(value, version, size, expires_at, local_timeout, now)
+            self.nr_bytes += size
+            while self.nr_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+        return size
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.nr_bytes -= entry.size
 
 
 def _init_local_cache():
     from common import settings
-    global _cache_backend
+    global _initialized, _cache_backend, _redis_client, _key_prefix, _local_cache
+    global _compression, _compress_min_bytes
 
-    if settings.CACHE_TYPE == 'simple':
-        from flask_caching.backends.simple import SimpleCache
+    _local_cache = LocalCache(settings.CACHE_LOCAL_MAX_MB * 1024 * 1024)
 
-        _cache_backend = SimpleCache()
-    elif settings.CACHE_TYPE == 'redis':
+    _compression = settings.CACHE_COMPRESSION or None
+    _compress_min_bytes = settings.CACHE_COMPRESSION_MIN_KB * 1024
+    if _compression and not cache_serialization.is_codec_available(_compression):
+        logger.warning('Cache compression %s is not available, storing values uncompressed' % _compression)
+        _compression = None
+
+    # With the simple cache type the local cache is the only layer
+    if settings.CACHE_TYPE == 'redis':
         from redis import from_url as redis_from_url
         from flask_caching.backends.rediscache import RedisCache
 
+        _redis_client = redis_from_url(settings.CACHE_REDIS_URL)
+        _key_prefix = settings.CACHE_KEY_PREFIX
         _cache_backend = RedisCache(
             key_prefix=settings.CACHE_KEY_PREFIX,
-            host=redis_from_url(settings.CACHE_REDIS_URL)
+            host=_redis_client,
+            default_timeout=DEFAULT_TIMEOUT,
         )
 
+    _initialized = True
+
+
+def _purge_expired(store, now):
+    """Removes the entries of `store`, values of which are (value, expiry time) pairs, that have expired"""
+
+    expired = [key for key, (_, expires_at) in store.items() if expires_at is not None and now >= expires_at]
+    for key in expired:
+        del store[key]
+
+
+def _parse_local_timeout(version):
+    return float(version.rsplit(':', 1)[1])
+
 
 def get(key):
-    if _cache_backend is None:
+    if not _initialized:
         _init_local_cache()
 
-    return _cache_backend.get(key)
+    group = cache_stats.get_key_group(key)
+    start = time.perf_counter()
+    value = _get(key, group)
+    cache_stats.observe(group, 'get_ms', (time.perf_counter() - start) * 1000)
+    return value
+
+
+def _get(key, group):
+    now = time.monotonic()
+    entry = _local_cache.get(key, now)
+    if _redis_client is None:
+        if entry is None:
+            cache_stats.incr(group, 'misses')
+            return None
+        cache_stats.incr(group, 'local_hits')
+        return copy_value(entry.value)
+
+    if entry is not None and now < entry.trusted_until:
+        cache_stats.incr(group, 'local_hits')
+        return copy_value(entry.value)
+
+    redis_key = _key_prefix + key
+    if entry is not None:
+        # Revalidate the local copy by comparing only the version tags
+        version = _redis_client.get(redis_key + VERSION_SUFFIX)
+        if version is not None and version.decode('utf8') == entry.version:
+            entry.trusted_until = now + entry.local_timeout
+            cache_stats.incr(group, 'revalidated_hits')
+            return copy_value(entry.value)
 
+    raw_value, version = _redis_client.mget([redis_key, redis_key + VERSION_SUFFIX])
+    if raw_value is None:
+        _local_cache.delete(key)
+        cache_stats.incr(group, 'misses')
+        return None
 
-def set(key, val, timeout=None):
-    if _cache_backend is None:
+    cache_stats.incr(group, 'remote_hits')
+    cache_stats.observe_size(group, 'fetched_bytes', len(raw_value))
+    if cache_serialization.is_serialized(raw_value):
+        value = cache_serialization.loads(raw_value)
+    else:
+        # Stored by an older version
+        value = _cache_backend.load_object(raw_value)
+    if version is not None:
+        version = version.decode('utf8')
+        _local_cache.set(key, copy_value(value), version, None, _parse_local_timeout(version), now)
+    else:
+        _local_cache.delete(key)
+    return value
+
+
+def set(key, val, timeout=None, local_timeout=0):
+    """Stores `val` in the local and the shared cache.
+
+    `timeout` is the lifetime of the entry in seconds. The local copy is
+    checked against the version of the shared entry on every access, unless
+    it was set less than `local_timeout` seconds ago.
+    """
+    if not _initialized:
+        _init_local_cache()
+
+    group = cache_stats.get_key_group(key)
+    start = time.perf_counter()
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    version = '%s:%s' % (uuid.uuid4().hex, local_timeout)
+
+    if _redis_client is not None:
+        redis_key = _key_prefix + key
+        dump = cache_serialization.dumps(val, _compression, _compress_min_bytes)
+        cache_stats.observe_size(group, 'stored_bytes', len(dump))
+        pipe = _redis_client.pipeline(transaction=True)
+        pipe.set(redis_key, dump, ex=timeout or None)
+        pipe.set(redis_key + VERSION_SUFFIX, version, ex=timeout or None)
+        pipe.execute()
+
+    size = _local_cache.set(key, copy_value(val), version, timeout, local_timeout, time.monotonic())
+    if _redis_client is None:
+        cache_stats.observe_size(group, 'stored_bytes', size)
+    cache_stats.observe(group, 'set_ms', (time.perf_counter() - start) * 1000)
+
+
+def update_record(key, timeout=None, channel=None, **fields):
+    """Sets the given fields of the record `key` and renews its timeout.
+
+    A record is a dict of values that is stored as a Redis hash, so it is
+    read and updated in a single round trip. Records bypass the local cache
+    when Redis is used. If `channel` is given, its subscribers are notified
+    of the update.
+    """
+    if not _initialized:
+        _init_local_cache()
+
+    group = cache_stats.get_key_group(key)
+    start = time.perf_counter()
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+
+    if _redis_client is not None:
+        mapping = {name: cache_serialization.dumps(val) for name, val in fields.items()}
+        cache_stats.observe_size(group, 'stored_bytes', sum(len(x) for x in mapping.values()))
+        redis_key = _key_prefix + key
+        pipe = _redis_client.pipeline(transaction=True)
+        pipe.hset(redis_key, mapping=mapping)
+        if timeout:
+            pipe.expire(redis_key, timeout)
+        if channel is not None:
+            pipe.publish(_key_prefix + channel, key)
+        pipe.execute()
+    else:
+        with _record_lock:
+            now = time.monotonic()
+            _purge_expired(_local_records, now)
+            record = dict(_local_records.get(key, ({}, None))[0])
+            record.update(copy_value(fields))
+            _local_records[key] = (record, now + timeout if timeout else None)
+        if channel is not None:
+            publish(channel, key)
+
+    cache_stats.observe(group, 'set_ms', (time.perf_counter() - start) * 1000)
+
+
+def get_record(key, fields=None):
+    """Returns the record `key` as a dict or None if it does not exist.
+
+    With `fields`, only the given fields are fetched.
+    """
+    if not _initialized:
         _init_local_cache()
 
-    _cache_backend.set(key, val)
+    group = cache_stats.get_key_group(key)
+    start = time.perf_counter()
+
+    if _redis_client is not None:
+        if fields is not None:
+            values = _redis_client.hmget(_key_prefix + key, list(fields))
+            raw = {name.encode('utf8'): val for name, val in zip(fields, values) if val is not None}
+        else:
+            raw = _redis_client.hgetall(_key_prefix + key)
+        if raw:
+            cache_stats.observe_size(group, 'fetched_bytes', sum(len(x) for x in raw.values()))
+            record = {name.decode('utf8'): cache_serialization.loads(val) for name, val in raw.items()}
+        else:
+            record = None
+    else:
+        with _record_lock:
+            _purge_expired(_local_records, time.monotonic())
+            record = _local_records.get(key, (None, None))[0]
+        if record is not None:
+            if fields is not None:
+                record = {name: record[name] for name in fields if name in record}
+            record = copy_value(record)
+
+    if record is None:
+        cache_stats.incr(group, 'misses')
+    else:
+        cache_stats.incr(group, 'remote_hits' if _redis_client is not None else 'local_hits')
+    cache_stats.observe(group, 'get_ms', (time.perf_counter() - start) * 1000)
+    return record
+
+
+def publish(channel, message):
+    """Notifies the subscribers of `channel`"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        _redis_client.publish(_key_prefix + channel, message)
+        return
+
+    with _local_channels:
+        if channel in _local_channel_subscribers:
+            _local_channel_seqs[channel] += 1
+            _local_channels.notify_all()
+
+
+class RedisSubscription:
+    # Messages are passed between all the processes using the same Redis
+    is_shared = True
+
+    def __init__(self, channel):
+        self.pubsub = _redis_client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(_key_prefix + channel)
+
+    def wait(self, timeout):
+        """Waits for a message for at most `timeout` seconds. Returns True if one arrived."""
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.pubsub.get_message(timeout=remaining) is not None:
+                break
+        # Only the latest state matters, so skip the queued messages
+        while self.pubsub.get_message() is not None:
+            pass
+        return True
+
+    def close(self):
+        self.pubsub.close()
+
+
+class LocalSubscription:
+    # Only messages published in this process are received
+    is_shared = False
+
+    def __init__(self, channel):
+        self.channel = channel
+        with _local_channels:
+            if channel not in _local_channel_subscribers:
+                _local_channel_subscribers[channel] = 0
+                _local_channel_seqs[channel] = 0
+            _local_channel_subscribers[channel] += 1
+            self.seq = _local_channel_seqs[channel]
+
+    def wait(self, timeout):
+        """Waits for a message for at most `timeout` seconds. Returns True if one arrived."""
+
+        with _local_channels:
+            arrived = _local_channels.wait_for(lambda: _local_channel_seqs[self.channel] != self.seq, timeout)
+            self.seq = _local_channel_seqs[self.channel]
+        return arrived
+
+    def close(self):
+        with _local_channels:
+            _local_channel_subscribers[self.channel] -= 1
+            if not _local_channel_subscribers[self.channel]:
+                del _local_channel_subscribers[self.channel]
+                del _local_channel_seqs[self.channel]
+
+
+def subscribe(channel):
+    """Returns a subscription to the messages published to `channel`.
+
+    The subscription must be closed after use.
+    """
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return RedisSubscription(channel)
+    return LocalSubscription(channel)
+
+
+def queue_push(queue, item, score):
+    """Adds `item` to the priority queue `queue`, lowest score first.
+
+    An item that is already queued keeps its place. Returns True if the item
+    was added.
+    """
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return bool(_redis_client.zadd(_key_prefix + queue, {item: score}, nx=True))
+
+    with _queue_lock:
+        items = _local_queues.setdefault(queue, {})
+        if item in items:
+            return False
+        items[item] = score
+    return True
+
+
+def queue_pop(queue):
+    """Removes and returns the item with the lowest score, or None if the queue is empty"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        ret = _redis_client.zpopmin(_key_prefix + queue)
+        if not ret:
+            return None
+        return ret[0][0].decode('utf8')
+
+    with _queue_lock:
+        items = _local_queues.get(queue)
+        if not items:
+            return None
+        item = min(items, key=items.get)
+        del items[item]
+    return item
+
+
+def queue_remove(queue, item):
+    """Removes `item` from the queue. Returns True if it was queued."""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return bool(_redis_client.zrem(_key_prefix + queue, item))
+
+    with _queue_lock:
+        items = _local_queues.get(queue, {})
+        return items.pop(item, None) is not None
+
+
+def queue_rank(queue, item):
+    """Returns the number of items ahead of `item`, or None if it is not queued"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return _redis_client.zrank(_key_prefix + queue, item)
+
+    with _queue_lock:
+        items = _local_queues.get(queue, {})
+        if item not in items:
+            return None
+        score = items[item]
+        return sum(1 for x, y in items.items() if (y, x) < (score, item))
+
+
+def queue_length(queue):
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return _redis_client.zcard(_key_prefix + queue)
+
+    with _queue_lock:
+        return len(_local_queues.get(queue, {}))
+
+
+def is_shared():
+    """Returns True if the cache is shared between processes"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    return _redis_client is not None
+
+
+def set_add(key, member, timeout=None):
+    """Adds `member` to the set `key` and renews its timeout"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+
+    if _redis_client is not None:
+        redis_key = _key_prefix + key
+        pipe = _redis_client.pipeline(transaction=True)
+        pipe.sadd(redis_key, member)
+        pipe.expire(redis_key, timeout)
+        pipe.execute()
+        return
+
+    with _set_lock:
+        now = time.monotonic()
+        _purge_expired(_local_sets, now)
+        # The members are the keys of a dict, as set() is shadowed in this module
+        members = _local_sets.get(key, ({}, None))[0]
+        members[member] = True
+        _local_sets[key] = (members, now + timeout)
+
+
+def set_remove(key, member):
+    """Removes `member` from the set `key`. Returns the number of members left."""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        redis_key = _key_prefix + key
+        pipe = _redis_client.pipeline(transaction=True)
+        pipe.srem(redis_key, member)
+        pipe.scard(redis_key)
+        return pipe.execute()[1]
+
+    with _set_lock:
+        _purge_expired(_local_sets, time.monotonic())
+        members = _local_sets.get(key, ({}, None))[0]
+        members.pop(member, None)
+        return len(members)
+
+
+def claim(key, timeout, owner=None):
+    """Atomically claims `key` for `owner` unless someone else holds it.
+
+    Claiming a key the owner already holds extends the claim. Claims expire
+    after `timeout` seconds, so the claim of a crashed process does not block
+    others forever.
+
+    Returns a tuple (claimed, owner) where `owner` is the current holder.
+    """
+    if not _initialized:
+        _init_local_cache()
+
+    if owner is None:
+        owner = str(uuid.uuid4())
+
+    if _redis_client is not None:
+        holder = _redis_client.eval(CLAIM_SCRIPT, 1, _key_prefix + key, owner, int(timeout * 1000))
+        if isinstance(holder, bytes):
+            holder = holder.decode('utf8')
+        return (holder == owner, holder)
+
+    with _claim_lock:
+        now = time.monotonic()
+        _purge_expired(_local_claims, now)
+        holder = _local_claims.get(key, (None, None))[0]
+        if holder is None or holder == owner:
+            _local_claims[key] = (owner, now + timeout)
+            holder = owner
+    return (holder == owner, holder)
+
+
+def release_claim(key, owner):
+    """Releases the claim on `key` if `owner` still holds it"""
+
+    if not _initialized:
+        _init_local_cache()
+
+    if _redis_client is not None:
+        return bool(_redis_client.eval(RELEASE_SCRIPT, 1, _key_prefix + key, owner))
+
+    with _claim_lock:
+        _purge_expired(_local_claims, time.monotonic())
+        if _local_claims.get(key, (None, None))[0] != owner:
+            return False
+        del _local_claims[key]
+    return True
 
 
 def init_app(app):
-    global memoize, get, set
+    """Sets up the memoize decorator of flask-caching for `app`.
+
+    get() and set() keep storing the values in the format of this module.
+    flask-caching pickles the memoized values in its own format, so they are
+    kept under a key prefix of their own.
+    """
+    global memoize
 
+    key_prefix = '%s-memoize:' % app.config.get('CACHE_KEY_PREFIX', '')
     _cache = Cache()
-    _cache.init_app(app)
+    _cache.init_app(app, config={'CACHE_KEY_PREFIX': key_prefix})
 
     memoize = _cache.memoize
-    get = _cache.get
-    set = _cache.set
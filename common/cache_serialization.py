@@ -0,0 +1,113 @@
+"""Serialization of the values stored in the shared cache.
+
+Values are pickled with protocol 5, so the data of NumPy arrays (and of the
+DataFrames built on them) is passed as out-of-band buffers instead of being
+copied into the pickle stream. Payloads larger than a threshold can be
+compressed with lz4 or zstd, if the module is installed.
+
+A serialized value consists of MAGIC, a codec byte and the body, which is
+compressed as a whole. The body starts with the number of buffers, the
+length of the pickle and the lengths of the buffers, followed by the pickle
+and the buffers.
+"""
+import pickle
+import struct
+
+MAGIC = b'\xffPB5'
+
+CODEC_NONE = 0
+CODEC_LZ4 = 1
+CODEC_ZSTD = 2
+
+CODECS = {
+    'lz4': CODEC_LZ4,
+    'zstd': CODEC_ZSTD,
+}
+
+_codec_funcs = {}
+
+
+def _load_codec(codec):
+    if codec == CODEC_LZ4:
+        import lz4.frame
+
+        return lz4.frame.compress, lz4.frame.decompress
+
+    import zstandard
+
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def get_codec_funcs(codec):
+    """Returns the (compress, decompress) functions of `codec`"""
+
+    funcs = _codec_funcs.get(codec)
+    if funcs is None:
+        funcs = _codec_funcs[codec] = _load_codec(codec)
+    return funcs
+
+
+def is_codec_available(name):
+    if name not in CODECS:
+        return False
+    try:
+        get_codec_funcs(CODECS[name])
+    except ImportError:
+        return False
+    return True
+
+
+def is_serialized(raw):
+    """Returns True if `raw` was produced by dumps()"""
+
+    return raw[:len(MAGIC)] == MAGIC
+
+
+def dumps(obj, compression=None, compress_min_bytes=0):
+    """Serializes `obj` to bytes.
+
+    The payload is compressed with `compression` ('lz4' or 'zstd') if it
+    is at least `compress_min_bytes` long.
+    """
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [buf.raw() for buf in buffers]
+
+    header = struct.pack('<II%dQ' % len(raws), len(raws), len(data), *[raw.nbytes for raw in raws])
+    parts = [header, data] + raws
+
+    size = sum(len(part) if isinstance(part, bytes) else part.nbytes for part in parts)
+    if compression and size >= compress_min_bytes:
+        codec = CODECS[compression]
+        compress, _ = get_codec_funcs(codec)
+        return MAGIC + bytes([codec]) + compress(b''.join(parts))
+
+    return b''.join([MAGIC, bytes([CODEC_NONE])] + parts)
+
+
+def loads(raw):
+    """Deserializes a value produced by dumps()"""
+
+    codec = raw[len(MAGIC)]
+    body = memoryview(raw)[len(MAGIC) + 1:]
+    if codec != CODEC_NONE:
+        _, decompress = get_codec_funcs(codec)
+        body = decompress(body)
+
+    # The arrays are views into a single writable copy of the body, so they
+    # can be modified like the arrays of an in-band pickle.
+    body = memoryview(bytearray(body))
+
+    nr_buffers, data_len = struct.unpack_from('<II', body, 0)
+    offset = struct.calcsize('<II')
+    lengths = struct.unpack_from('<%dQ' % nr_buffers, body, offset)
+    offset += struct.calcsize('<%dQ' % nr_buffers)
+
+    data = body[offset:offset + data_len]
+    offset += data_len
+    buffers = []
+    for length in lengths:
+        buffers.append(body[offset:offset + length])
+        offset += length
+
+    return pickle.loads(data, buffers=buffers)
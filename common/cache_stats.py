@@ -0,0 +1,98 @@
+"""Per-process counters and histograms of the calcfunc and cache operations.
+
+The stats are grouped by calcfunc name. Cache keys are mapped to the name of
+the calcfunc they belong to, with the suffix of derived keys such as
+`-results` kept, so the run progress entries are reported separately.
+"""
+import bisect
+import os
+import threading
+import time
+
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+_lock = threading.Lock()
+_stats = {}
+_started_at = time.time()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last slot counts the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        bounds = [str(x) for x in self.buckets] + ['inf']
+        return dict(count=self.count, sum=self.sum, buckets=dict(zip(bounds, self.counts)))
+
+
+class GroupStats:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def as_dict(self):
+        return dict(
+            counters=dict(self.counters),
+            histograms={name: h.as_dict() for name, h in self.histograms.items()},
+        )
+
+
+def get_key_group(key):
+    """Returns the stats group of a cache key"""
+
+    name, _, rest = key.partition(':')
+    if '-' in rest:
+        return '%s-%s' % (name, rest.rpartition('-')[2])
+    return name
+
+
+def _get_group(group):
+    stats = _stats.get(group)
+    if stats is None:
+        stats = _stats[group] = GroupStats()
+    return stats
+
+
+def incr(group, counter, value=1):
+    with _lock:
+        counters = _get_group(group).counters
+        counters[counter] = counters.get(counter, 0) + value
+
+
+def observe(group, histogram, value, buckets=LATENCY_BUCKETS_MS):
+    with _lock:
+        histograms = _get_group(group).histograms
+        h = histograms.get(histogram)
+        if h is None:
+            h = histograms[histogram] = Histogram(buckets)
+        h.observe(value)
+
+
+def observe_size(group, histogram, nr_bytes):
+    observe(group, histogram, nr_bytes, buckets=SIZE_BUCKETS)
+
+
+def get_stats():
+    """Returns a snapshot of the stats of this process"""
+
+    with _lock:
+        groups = {group: stats.as_dict() for group, stats in _stats.items()}
+    return dict(pid=os.getpid(), since=_started_at, groups=groups)
+
+
+def reset_stats():
+    global _started_at
+
+    with _lock:
+        _stats.clear()
+        _started_at = time.time()
@@ -12,6 +12,12 @@ BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 CACHE_KEY_PREFIX = 'ghgdash-cache'
 CACHE_TYPE = 'simple'
 CACHE_REDIS_URL = None
+# Memory budget of the per-process cache of decoded objects
+CACHE_LOCAL_MAX_MB = int(os.getenv('CACHE_LOCAL_MAX_MB', '256'))
+# Values stored in Redis that are larger than CACHE_COMPRESSION_MIN_KB are
+# compressed with CACHE_COMPRESSION ('lz4' or 'zstd', the module must be installed)
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', '').lower()
+CACHE_COMPRESSION_MIN_KB = int(os.getenv('CACHE_COMPRESSION_MIN_KB', '64'))
 
 SESSION_TYPE = 'filesystem'
 SESSION_FILE_DIR = os.path.join(BASE_DIR, 'flask_session')
@@ -25,6 +31,44 @@ BASE_URL = os.getenv('BASE_URL', None)
 TRAFFIC_WARNING = os.getenv('TRAFFIC_WARNING', '').lower() in ('1', 'yes', 'true')
 RESTRICT_TO_PRESET_SCENARIOS = os.getenv('RESTRICT_TO_PRESET_SCENARIOS', '').lower() in ('1', 'yes', 'true')
 
+# Collect per-phase timings of each simulated day into the results
+SIMULATION_PHASE_TIMINGS = os.getenv('SIMULATION_PHASE_TIMINGS', '').lower() in ('1', 'yes', 'true')
+
+# How many pristine simulation contexts each process keeps around for cloning
+SIMULATION_TEMPLATE_CACHE_SIZE = int(os.getenv('SIMULATION_TEMPLATE_CACHE_SIZE', '2'))
+# How many finished runs each process keeps around so that longer runs
+# with otherwise the same variables can continue from them
+SIMULATION_RESUMABLE_RUNS = int(os.getenv('SIMULATION_RESUMABLE_RUNS', '1'))
+
+# Where the results of the preset scenarios are stored, by default under DATASET_PATH
+PRECOMPUTED_RESULTS_PATH = os.getenv('PRECOMPUTED_RESULTS_PATH', None)
+
+# Long-lived simulation worker processes per server process. With 0, every
+# run is started in a freshly forked process instead.
+SIMULATION_WORKERS = int(os.getenv('SIMULATION_WORKERS', '4'))
+# Workers are replaced after this many runs or when their peak memory use
+# exceeds the limit.
+SIMULATION_WORKER_MAX_JOBS = int(os.getenv('SIMULATION_WORKER_MAX_JOBS', '50'))
+SIMULATION_WORKER_MAX_MEMORY_MB = int(os.getenv('SIMULATION_WORKER_MAX_MEMORY_MB', '2048'))
+# Simulations running at the same time per host, shared by all the server
+# processes. With 0, the number of CPUs available to the process.
+SIMULATION_MAX_CONCURRENCY = int(os.getenv('SIMULATION_MAX_CONCURRENCY', '0'))
+# New runs are refused when this many are waiting in the shared queue
+SIMULATION_MAX_QUEUED = int(os.getenv('SIMULATION_MAX_QUEUED', '100'))
+# Runs one session may have queued or running at the same time
+SIMULATION_SESSION_MAX_RUNS = int(os.getenv('SIMULATION_SESSION_MAX_RUNS', '2'))
+# Server-Sent Event streams each server process serves at the same time. Keep
+# it below GUNICORN_THREADS, so that other requests are served meanwhile.
+SIMULATION_MAX_EVENT_STREAMS = int(os.getenv('SIMULATION_MAX_EVENT_STREAMS', '8'))
+
+# How often (in seconds) calcfuncs check whether their file dependencies have changed
+CALCFUNC_FILEDEP_CHECK_INTERVAL = float(os.getenv('CALCFUNC_FILEDEP_CHECK_INTERVAL', '5'))
+# Threads per process that recompute stale-while-revalidate calcfuncs
+CALCFUNC_REFRESH_WORKERS = int(os.getenv('CALCFUNC_REFRESH_WORKERS', '2'))
+# Threads per process that compute the dependencies of a calcfunc concurrently
+# before it is evaluated (0 disables)
+CALCFUNC_PREFETCH_WORKERS = int(os.getenv('CALCFUNC_PREFETCH_WORKERS', '4'))
+
 
 def get_cache_config():
     global CACHE_TYPE, CACHE_REDIS_URL
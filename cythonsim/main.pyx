@@ -18,7 +18,8 @@ cimport cython
 cimport openmp
 from cpython.mem cimport PyMem_Malloc, PyMem_Free  # isort:skip
 from libc.stdlib cimport malloc, free  # isort:skip
-from libc.string cimport memset
+from libc.string cimport memcpy, memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 cimport numpy as cnp
 
 from cythonsim.simrandom cimport RandomPool  # isort:skip
@@ -121,6 +122,33 @@ PROBLEM_TO_STR = {
 }
 
 
+cdef enum TimingPhase:
+    PHASE_INTERVENTIONS
+    PHASE_INIT_DAY
+    PHASE_HEALTHCARE
+    PHASE_CONTACT_SAMPLING
+    PHASE_EXPOSURE
+    PHASE_ADVANCE
+
+DEF NR_TIMING_PHASES = 6
+
+TIMING_PHASE_TO_STR = {
+    TimingPhase.PHASE_INTERVENTIONS: 'interventions',
+    TimingPhase.PHASE_INIT_DAY: 'init_day',
+    TimingPhase.PHASE_HEALTHCARE: 'healthcare',
+    TimingPhase.PHASE_CONTACT_SAMPLING: 'contact_sampling',
+    TimingPhase.PHASE_EXPOSURE: 'exposure',
+    TimingPhase.PHASE_ADVANCE: 'advance',
+}
+TIMING_PHASES = tuple(TIMING_PHASE_TO_STR[i] for i in range(NR_TIMING_PHASES))
+
+
+cdef inline long long now_ns() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return <long long> ts.tv_sec * 1000000000 + ts.tv_nsec
+
+
 class SimulationFailed(Exception):
     pass
 
@@ -250,8 +278,14 @@ cdef void person_expose_others(Person *self, Context context) nogil:
     cdef int32 *infectees
     cdef int nr_contacts, exposee_idx, total, i
     cdef Person *target
+    cdef long long start_ns = 0
 
+    if context.collect_timings:
+        start_ns = now_ns()
     nr_contacts = context.disease.get_exposed_people(self, contacts, context)
+    if context.collect_timings:
+        context.phase_ns[PHASE_CONTACT_SAMPLING] += now_ns() - start_ns
+
     self.other_people_exposed_today = nr_contacts
     if nr_contacts == 0:
         return
@@ -264,6 +298,9 @@ cdef void person_expose_others(Person *self, Context context) nogil:
 
     self.other_people_exposed_today = nr_contacts
 
+    if context.collect_timings:
+        start_ns = now_ns()
+
     infectees = self.infectees
     for i in range(nr_contacts):
         exposee_idx = contacts[i].person_idx
@@ -280,6 +317,9 @@ cdef void person_expose_others(Person *self, Context context) nogil:
                 infectees[self.other_people_infected] = exposee_idx
             self.other_people_infected += 1
 
+    if context.collect_timings:
+        context.phase_ns[PHASE_EXPOSURE] += now_ns() - start_ns
+
 
 cdef void person_become_ill(Person *self, Context context) nogil:
     self.state = PersonState.ILLNESS
@@ -471,6 +511,22 @@ cdef class HealthcareSystem:
         self.vaccinations = []
         openmp.omp_init_lock(&self.lock)
 
+    cdef HealthcareSystem copy(self):
+        cdef HealthcareSystem other = HealthcareSystem.__new__(HealthcareSystem)
+
+        other.beds = self.beds
+        other.icu_units = self.icu_units
+        other.available_beds = self.available_beds
+        other.available_icu_units = self.available_icu_units
+        other.testing_mode = self.testing_mode
+        other.testing_queue = list(self.testing_queue)
+        other.ct_cases_per_day = self.ct_cases_per_day
+        other.p_detected_anyway = self.p_detected_anyway
+        other.p_successful_tracing = self.p_successful_tracing
+        other.vaccinations = [dict(v) for v in self.vaccinations]
+        openmp.omp_init_lock(&other.lock)
+        return other
+
     cdef bint queue_for_testing(self, int person_idx, Context context, float p_success) nogil:
         cdef Person *p = context.pop.people + person_idx
         if p.state == PersonState.DEAD or p.was_detected or p.queued_for_testing:
@@ -702,6 +758,16 @@ cdef void cv_init(ClassifiedValues *self, object pairs):
             self.max_class = kls
 
 
+cdef void cv_copy(ClassifiedValues *self, ClassifiedValues *src):
+    self.num_classes = src.num_classes
+    self.min_class = src.min_class
+    self.max_class = src.max_class
+    self.classes = <int *> PyMem_Malloc(self.num_classes * sizeof(int))
+    self.values = <float *> PyMem_Malloc(self.num_classes * sizeof(float))
+    memcpy(self.classes, src.classes, self.num_classes * sizeof(int))
+    memcpy(self.values, src.values, self.num_classes * sizeof(float))
+
+
 cdef void cv_free(ClassifiedValues *cv):
     PyMem_Free(cv.classes)
     PyMem_Free(cv.values)
@@ -1103,6 +1169,10 @@ cdef struct AgeContactProbabilities:
     int count
 
 
+# Population images are only valid for the same struct layouts
+IMAGE_STRUCT_SIZES = dict(person=sizeof(Person), contact_probability=sizeof(ContactProbability))
+
+
 cdef class MobilityFactor:
     cdef public ContactPlace place
     cdef public int min_age
@@ -1117,7 +1187,8 @@ cdef class MobilityFactor:
 
 
 cdef class ContactMatrix:
-    cdef object contact_df  # pandas.DataFrame
+    # Integer-coded contact table from calc.simulation.get_contacts_per_day()
+    cdef dict contacts
     cdef object mask_probabilities  # pandas.DataFrame
     cdef double[::1] nr_contacts_by_age
     cdef AgeContactProbabilities *p_by_age
@@ -1128,11 +1199,11 @@ cdef class ContactMatrix:
     cdef float mobility_factor
     cdef object stats  # pandas.DataFrame
 
-    def __init__(self, contacts_per_day, nr_ages):
+    def __init__(self, contacts_per_day, nr_ages, image=None):
         cdef int age
 
         self.nr_contacts_by_age = np.zeros(nr_ages, dtype=np.double)
-        self.contact_df = contacts_per_day.copy(deep=True)
+        self.contacts = {key: np.ascontiguousarray(arr) for key, arr in contacts_per_day.items()}
         self.nr_ages = nr_ages
         self.mobility_factor = 1.0
         self.mobility_factors = []
@@ -1141,15 +1212,90 @@ cdef class ContactMatrix:
         cdef AgeContactProbabilities *acp
         self.p_by_age = <AgeContactProbabilities *> PyMem_Malloc(nr_ages * sizeof(AgeContactProbabilities))
 
-        s = self.contact_df.groupby('participant_age').size()
-        for age, count in s.items():
+        self.generate_mask_probability_matrix()
+        if image is not None:
+            self._load_probabilities(image)
+            return
+
+        counts = np.bincount(self.contacts['participant_age'], minlength=nr_ages)
+        for age in range(nr_ages):
             acp = self.p_by_age + age
-            acp.count = count
+            acp.count = counts[age]
             acp.probabilities = <ContactProbability *> PyMem_Malloc(acp.count * sizeof(ContactProbability))
 
-        self.generate_mask_probability_matrix()
         self.generate_contact_probabilities()
 
+    cdef _load_probabilities(self, image):
+        cdef const int32[::1] counts = image['contact_counts']
+        cdef const unsigned char[::1] table = image['contact_probabilities']
+        cdef const double[::1] nr_contacts = image['nr_contacts_by_age']
+        cdef AgeContactProbabilities *acp
+        cdef size_t offset = 0, size
+        cdef int age
+
+        if table.shape[0] != np.sum(image['contact_counts']) * sizeof(ContactProbability):
+            raise ValueError('Contact probability table size mismatch')
+
+        for age in range(self.nr_ages):
+            acp = self.p_by_age + age
+            acp.count = counts[age]
+            size = acp.count * sizeof(ContactProbability)
+            acp.probabilities = <ContactProbability *> PyMem_Malloc(size)
+            if size:
+                memcpy(acp.probabilities, &table[offset], size)
+            offset += size
+            self.nr_contacts_by_age[age] = nr_contacts[age]
+
+    cdef dict _export_probabilities(self):
+        cdef AgeContactProbabilities *acp
+        cdef unsigned char[::1] table
+        cdef size_t offset = 0, size
+        cdef int age
+
+        counts = np.array([self.p_by_age[age].count for age in range(self.nr_ages)], dtype=np.int32)
+        table = np.empty(counts.sum() * sizeof(ContactProbability), dtype=np.uint8)
+        for age in range(self.nr_ages):
+            acp = self.p_by_age + age
+            size = acp.count * sizeof(ContactProbability)
+            if size:
+                memcpy(&table[offset], acp.probabilities, size)
+            offset += size
+
+        return dict(
+            contact_counts=counts,
+            contact_probabilities=np.asarray(table),
+            nr_contacts_by_age=np.array(self.nr_contacts_by_age, dtype=np.double),
+        )
+
+    cdef ContactMatrix copy(self):
+        cdef ContactMatrix other = ContactMatrix.__new__(ContactMatrix)
+        cdef AgeContactProbabilities *src
+        cdef AgeContactProbabilities *dst
+        cdef int age
+
+        # The contact table itself is never modified, so it can be shared.
+        other.contacts = self.contacts
+        other.mask_probabilities = self.mask_probabilities.copy()
+        other.nr_contacts_by_age = np.array(self.nr_contacts_by_age, dtype=np.double)
+        other.nr_ages = self.nr_ages
+        other.mobility_factor = self.mobility_factor
+        other.mobility_factors = [
+            MobilityFactor(mf.place, mf.min_age, mf.max_age, mf.mobility_factor)
+            for mf in self.mobility_factors
+        ]
+        other.mobility_factor_changed = self.mobility_factor_changed
+        other.stats = self.stats
+
+        other.p_by_age = <AgeContactProbabilities *> PyMem_Malloc(self.nr_ages * sizeof(AgeContactProbabilities))
+        for age in range(self.nr_ages):
+            src = self.p_by_age + age
+            dst = other.p_by_age + age
+            dst.count = src.count
+            dst.probabilities = <ContactProbability *> PyMem_Malloc(src.count * sizeof(ContactProbability))
+            memcpy(dst.probabilities, src.probabilities, src.count * sizeof(ContactProbability))
+
+        return other
+
     def generate_contact_statistics(self, df):
         # df = df.groupby(['place_type', 'participant_age']).sum().reset_index()
         age_groups = pd.interval_range(0, 80, freq=10, closed='left')
@@ -1181,66 +1327,85 @@ cdef class ContactMatrix:
         ages = range(self.nr_ages)
         self.mask_probabilities = pd.DataFrame(0.0, index=ages, columns=places)
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def generate_contact_probabilities(self):
-        cdef int age, i
         cdef AgeContactProbabilities *acp
         cdef ContactProbability *cp
+        cdef int age, i, nr_rows
 
-        # pc = PerfCounter('cp', show_time_to_last=True)
-
-        for age in range(self.nr_ages):
-            acp = self.p_by_age + age
-            acp.count = 0
+        cdef const int32[::1] places = self.contacts['place']
+        cdef const int32[::1] participant_ages = self.contacts['participant_age']
+        cdef const int32[::1] contact_age_mins = self.contacts['contact_age_min']
+        cdef const int32[::1] contact_age_maxs = self.contacts['contact_age_max']
+        cdef double[::1] contacts, totals, cum_p
+        cdef double[:, ::1] mask_probabilities
 
-        df = self.contact_df.copy()
-        # pc.display('copy')
+        contacts_arr = np.array(self.contacts['contacts'], dtype=np.double)
+        ages_arr = np.asarray(self.contacts['participant_age'])
+        places_arr = np.asarray(self.contacts['place'])
 
         for mf in self.mobility_factors:
             if mf.mobility_factor == 1.0:
                 continue
-            filters = (df.participant_age >= mf.min_age) & (df.participant_age <= mf.max_age)
+            filters = (ages_arr >= mf.min_age) & (ages_arr <= mf.max_age)
             if mf.place != ContactPlace.ALL:
-                filters &= df.place_type == CONTACT_PLACE_TO_STR[mf.place]
-            df.loc[filters, 'contacts'] *= mf.mobility_factor
-        # pc.display('apply mf')
-
-        # self.generate_contact_statistics(df)
-
-        total_contacts = df.groupby('participant_age')['contacts'].sum()
-        for age, count in total_contacts.items():
-            self.nr_contacts_by_age[age] = count
-
-        df = df.set_index(['place_type', 'participant_age', 'contact_age']).sort_index()
-        df = df.unstack('participant_age')
-        df.columns = df.columns.droplevel(0)
-
-        df = df.divide(total_contacts, axis=1).cumsum()
-
-        str_to_place = {val: key for key, val in CONTACT_PLACE_TO_STR.items()}
+                filters &= places_arr == mf.place
+            contacts_arr[filters] *= mf.mobility_factor
 
-        # pc.display('mangle')
+        totals = np.bincount(ages_arr, weights=contacts_arr, minlength=self.nr_ages)
+        self.nr_contacts_by_age[:] = totals
 
-        for age in df.columns:
-            s = df[age].to_dict()
-            mask_probabilities = self.mask_probabilities.iloc[age].to_dict()
+        # The mask probability columns are in the order of the place codes
+        mask_probabilities = np.ascontiguousarray(self.mask_probabilities.values, dtype=np.double)
+        contacts = contacts_arr
+        nr_rows = contacts.shape[0]
 
-            for (place, (contact_age_min, contact_age_max)), cum_p in s.items():
-                acp = self.p_by_age + age
-                cp = acp.probabilities + acp.count
-                cp.place = str_to_place[place]
-                cp.contact_age_min = contact_age_min
-                cp.contact_age_max = contact_age_max
-                cp.cum_p = cum_p
-                cp.mask_p = mask_probabilities[place]
-                acp.count += 1
-
-        # pc.display('generate acp')
+        for age in range(self.nr_ages):
+            self.p_by_age[age].count = 0
+
+        # The rows are sorted by participant age, so each age gets a
+        # contiguous run of cumulative probabilities.
+        cum_p = np.zeros(self.nr_ages, dtype=np.double)
+        for i in range(nr_rows):
+            age = participant_ages[i]
+            # Nobody is met at an age with no contacts at all
+            if totals[age] > 0:
+                cum_p[age] += contacts[i] / totals[age]
+            acp = self.p_by_age + age
+            cp = acp.probabilities + acp.count
+            cp.place = <ContactPlace> places[i]
+            cp.contact_age_min = contact_age_mins[i]
+            cp.contact_age_max = contact_age_maxs[i]
+            cp.cum_p = cum_p[age]
+            cp.mask_p = mask_probabilities[age, places[i]]
+            acp.count += 1
+
+    def get_contact_probabilities(self, int age):
+        """Returns the cumulative contact probabilities of `age`.
+
+        The result is a list of (place, contact_age_min, contact_age_max,
+        cum_p, mask_p) tuples in the order they are sampled from.
+        """
+        cdef AgeContactProbabilities *acp = self.p_by_age + age
+        cdef ContactProbability *cp
+        cdef int i
 
+        out = []
+        for i in range(acp.count):
+            cp = acp.probabilities + i
+            out.append((
+                CONTACT_PLACE_TO_STR[cp.place], cp.contact_age_min, cp.contact_age_max, cp.cum_p, cp.mask_p
+            ))
+        return out
 
     def __dealloc__(self):
         cdef AgeContactProbabilities *acp
         cdef int i
 
+        if self.p_by_age == NULL:
+            return
+
         for i in range(self.nr_ages):
             acp = self.p_by_age + i
             PyMem_Free(acp.probabilities)
@@ -1320,10 +1485,15 @@ cdef class ContactMatrix:
         return nr_contacts
 
 
+# The agents may live in a memory-mapped image, which must stay mapped
+# until the agents are freed.
+@cython.no_gc_clear
 cdef class Population:
     # Agents
     cdef Person *people
     cdef int total_people
+    cdef bint owns_people
+    cdef object people_buffer
 
     cdef ClassifiedValues imported_infection_ages
 
@@ -1349,7 +1519,7 @@ cdef class Population:
     # Effects of interventions
     cdef int limit_mass_gatherings
 
-    def __init__(self, params, disease):
+    def __init__(self, params, disease, RandomPool random, image=None):
         self.nr_ages = params['age_structure'].index.max() + 1
 
         age_counts = np.empty(self.nr_ages, dtype=np.int32)
@@ -1359,10 +1529,13 @@ cdef class Population:
         self.limit_mass_gatherings = 0
 
         self._init_stats(age_counts)
-        self._create_agents(age_counts)
+        if image is None:
+            self._create_agents(age_counts, random)
+        else:
+            self._load_agents(image)
 
         self.weekly_infections = []
-        self.contact_matrix = ContactMatrix(params['contacts_per_day'], self.nr_ages)
+        self.contact_matrix = ContactMatrix(params['contacts_per_day'], self.nr_ages, image)
 
         self.age_group_labels = params['age_groups']['labels']
         self.age_group_indices = np.array(params['age_groups']['age_indices'], dtype=np.int32)
@@ -1378,7 +1551,133 @@ cdef class Population:
         cv_init(&self.imported_infection_ages, weighed)
 
         self.infected_by_variant = np.zeros(disease.nr_variants, dtype=np.int32)
+        if image is not None:
+            self._load_stats(image['state']['stats'])
+
+    cdef _load_agents(self, image):
+        # The agent array is used in place, so it must be a writable
+        # (e.g. a copy-on-write mapped) buffer.
+        cdef unsigned char[::1] buf = image['people']
+
+        if buf.shape[0] % sizeof(Person):
+            raise ValueError('Agent array size mismatch')
+        self.total_people = buf.shape[0] // sizeof(Person)
+        if self.total_people:
+            self.people = <Person *> &buf[0]
+        self.people_buffer = image['people']
+        self.owns_people = False
+
+        self.people_sorted_by_age = image['people_sorted_by_age']
+        self.age_start = image['age_start']
+
+    cdef _load_stats(self, stats):
+        self.susceptible = np.array(stats['susceptible'], dtype=np.int32)
+        self.infected = np.array(stats['infected'], dtype=np.int32)
+        self.detected = np.array(stats['detected'], dtype=np.int32)
+        self.all_detected = np.array(stats['all_detected'], dtype=np.int32)
+        self.all_infected = np.array(stats['all_infected'], dtype=np.int32)
+        self.recovered = np.array(stats['recovered'], dtype=np.int32)
+        self.hospitalized = np.array(stats['hospitalized'], dtype=np.int32)
+        self.in_ward = np.array(stats['in_ward'], dtype=np.int32)
+        self.in_icu = np.array(stats['in_icu'], dtype=np.int32)
+        self.cum_icu = np.array(stats['cum_icu'], dtype=np.int32)
+        self.non_hospital_deaths = np.array(stats['non_hospital_deaths'], dtype=np.int32)
+        self.dead = np.array(stats['dead'], dtype=np.int32)
+        self.vaccinated = np.array(stats['vaccinated'], dtype=np.int32)
+        self.new_infections = np.array(stats['new_infections'], dtype=np.int32)
+        self.infected_by_variant = np.array(stats['infected_by_variant'], dtype=np.int32)
+
+    cdef dict _export_stats(self):
+        return dict(
+            susceptible=list(self.susceptible),
+            infected=list(self.infected),
+            detected=list(self.detected),
+            all_detected=list(self.all_detected),
+            all_infected=list(self.all_infected),
+            recovered=list(self.recovered),
+            hospitalized=list(self.hospitalized),
+            in_ward=list(self.in_ward),
+            in_icu=list(self.in_icu),
+            cum_icu=list(self.cum_icu),
+            non_hospital_deaths=list(self.non_hospital_deaths),
+            dead=list(self.dead),
+            vaccinated=list(self.vaccinated),
+            new_infections=list(self.new_infections),
+            infected_by_variant=list(self.infected_by_variant),
+        )
 
+    cdef dict export_image(self):
+        cdef Person *p
+        cdef int i
+
+        for i in range(self.total_people):
+            if self.people[i].infectees != NULL:
+                raise ValueError('Agents with contact tracing state cannot be exported')
+
+        image = dict(
+            people=np.asarray(<unsigned char[:self.total_people * sizeof(Person)]> <unsigned char *> self.people),
+            people_sorted_by_age=np.asarray(self.people_sorted_by_age),
+            age_start=np.asarray(self.age_start),
+        )
+        image.update(self.contact_matrix._export_probabilities())
+        return image
+
+    cdef Population copy(self):
+        cdef Population other = Population.__new__(Population)
+        cdef Person *p
+        cdef int32 *infectees
+        cdef int i
+        cdef size_t size = self.total_people * sizeof(Person)
+
+        other.people = <Person *> PyMem_Malloc(size)
+        if other.people == NULL:
+            raise MemoryError()
+        memcpy(other.people, self.people, size)
+        other.total_people = self.total_people
+        other.owns_people = True
+
+        # Lists of infectees are owned by each agent
+        with nogil:
+            for i in range(other.total_people):
+                p = other.people + i
+                if p.infectees == NULL:
+                    continue
+                infectees = p.infectees
+                p.infectees = <int32 *> malloc(sizeof(int32) * MAX_INFECTEES)
+                if p.infectees != NULL:
+                    memcpy(p.infectees, infectees, sizeof(int32) * MAX_INFECTEES)
+
+        cv_copy(&other.imported_infection_ages, &self.imported_infection_ages)
+
+        # The indexes are never modified after creation, so they can be shared.
+        other.people_sorted_by_age = self.people_sorted_by_age
+        other.age_start = self.age_start
+        other.age_group_indices = self.age_group_indices
+        other.age_group_labels = self.age_group_labels
+        other.nr_ages = self.nr_ages
+
+        other.susceptible = np.array(self.susceptible, dtype=np.int32)
+        other.infected = np.array(self.infected, dtype=np.int32)
+        other.detected = np.array(self.detected, dtype=np.int32)
+        other.all_detected = np.array(self.all_detected, dtype=np.int32)
+        other.all_infected = np.array(self.all_infected, dtype=np.int32)
+        other.recovered = np.array(self.recovered, dtype=np.int32)
+        other.hospitalized = np.array(self.hospitalized, dtype=np.int32)
+        other.in_ward = np.array(self.in_ward, dtype=np.int32)
+        other.in_icu = np.array(self.in_icu, dtype=np.int32)
+        other.cum_icu = np.array(self.cum_icu, dtype=np.int32)
+        other.non_hospital_deaths = np.array(self.non_hospital_deaths, dtype=np.int32)
+        other.dead = np.array(self.dead, dtype=np.int32)
+        other.vaccinated = np.array(self.vaccinated, dtype=np.int32)
+        other.new_infections = np.array(self.new_infections, dtype=np.int32)
+        other.infected_by_variant = np.array(self.infected_by_variant, dtype=np.int32)
+        other.daily_contacts = np.array(self.daily_contacts, dtype=np.int32)
+
+        other.contact_matrix = self.contact_matrix.copy()
+        other.weekly_infections = [dict(w) for w in self.weekly_infections]
+        other.limit_mass_gatherings = self.limit_mass_gatherings
+
+        return other
 
     def _init_stats(self, age_counts):
         cdef int nr_ages = self.nr_ages
@@ -1409,37 +1708,66 @@ cdef class Population:
 
     def __dealloc__(self):
         self._free_people()
-        PyMem_Free(self.people)
+        if self.owns_people:
+            PyMem_Free(self.people)
         cv_free(&self.imported_infection_ages)
 
 
-    cdef _create_agents(self, age_counts):
-        cdef int idx, person_idx, age
-        cdef Person * p
-        cdef cnp.ndarray[int] people_idx
+    @cython.cdivision(True)
+    cdef int _age_of_slot(self, int slot) nogil:
+        """Returns the age of the agent at the given position in the age-sorted index"""
+        cdef int lo = 0, hi = self.nr_ages - 1, mid
+
+        # Find the greatest age that starts at or before the slot
+        while lo < hi:
+            mid = (lo + hi + 1) / 2
+            if self.age_start[mid] <= slot:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    @cython.cdivision(True)
+    cdef _create_agents(self, age_counts, RandomPool random):
+        cdef int idx, j, person_idx, age, total, nr_ages = self.nr_ages
+        cdef int32[::1] counts = np.asarray(age_counts, dtype=np.int32)
+        cdef int32[::1] sorted_idx
+        cdef Person *people
 
         total = 0
-        for age, count in enumerate(age_counts):
-            total += count
+        self.age_start = np.empty(nr_ages, dtype=np.int32)
+        for age in range(nr_ages):
+            self.age_start[age] = total
+            total += counts[age]
 
         self.people_sorted_by_age = np.empty(total, dtype=np.int32)
-        self.age_start = np.empty(self.nr_ages, dtype=np.int32)
-
-        # Initialize list of people in random order
-        people_idx = np.array(np.arange(0, total), dtype='i')
-        np.random.shuffle(people_idx)
+        sorted_idx = self.people_sorted_by_age
 
         people = <Person *> PyMem_Malloc(total * sizeof(Person))
+        if people == NULL:
+            raise MemoryError()
+        self.owns_people = True
         memset(people, 0, total * sizeof(Person))
-        idx = 0
-        for age, count in enumerate(age_counts):
-            self.age_start[age] = idx
-            for i in range(count):
-                person_idx = people_idx[idx]
-                p = people + person_idx
-                person_init(p, person_idx, age)
-                self.people_sorted_by_age[idx] = person_idx
-                idx += 1
+
+        # Place the agents in random order in the age-sorted index using an
+        # inside-out Fisher-Yates shuffle. Agent `idx` lands in slot `j` and
+        # the agent previously in slot `j` moves to slot `idx`, taking the age
+        # of its new slot.
+        with nogil:
+            age = 0
+            for idx in range(total):
+                while age < nr_ages - 1 and idx >= self.age_start[age + 1]:
+                    age += 1
+                j = random.getint() % (idx + 1)
+                if j != idx:
+                    person_idx = sorted_idx[j]
+                    sorted_idx[idx] = person_idx
+                    people[person_idx].age = age
+                    person_init(people + idx, idx, self._age_of_slot(j))
+                else:
+                    person_init(people + idx, idx, age)
+                sorted_idx[j] = idx
+
         self.total_people = total
         self.people = people
 
@@ -1752,15 +2080,24 @@ cdef class Context:
     cdef int total_infections, total_infectors, exposed_per_day
     cdef float cross_border_mobility_factor
 
-    def __init__(self, population_params, healthcare_params, disease_params, str start_date, int random_seed=4321):
+    # Per-phase wall time of the latest iteration (nanoseconds)
+    cdef readonly bint collect_timings
+    cdef long long phase_ns[NR_TIMING_PHASES]
+
+    def __init__(
+        self, population_params, healthcare_params, disease_params, str start_date,
+        int random_seed=4321, bint collect_timings=False, image=None
+    ):
         self.random = RandomPool(random_seed)
+        self.collect_timings = collect_timings
+        self._reset_timings()
 
         self.problem = SimulationProblem.NO_PROBLEMOS
         self.problem_person = NULL
 
         ipc = population_params.pop('initial_population_condition', None)
         self.disease = Disease(disease_params)
-        self.pop = Population(population_params, self.disease)
+        self.pop = Population(population_params, self.disease, self.random, image)
         self.hc = HealthcareSystem(**healthcare_params)
 
         self.start_date = start_date
@@ -1773,9 +2110,33 @@ cdef class Context:
         self.total_infections = 0
         self.exposed_per_day = 0
 
-        if ipc and ipc.has_initial_state():
+        if image is not None:
+            # The image already contains the initial state
+            state = image['state']
+            self.hc.available_beds = state['available_beds']
+            self.hc.available_icu_units = state['available_icu_units']
+            self.random.set_state(state['rng'])
+        elif ipc and ipc.has_initial_state():
             self.pop.set_initial_state(ipc, self)
 
+    def export_image(self):
+        """Returns the agent arrays and the state needed to recreate this context.
+
+        The result can be passed as `image` to the constructor along with
+        the same parameters. Only pristine contexts can be exported.
+        """
+        if self.day != 0 or self.hc.testing_queue:
+            raise ValueError('Only pristine contexts can be exported')
+
+        image = self.pop.export_image()
+        image['state'] = dict(
+            stats=self.pop._export_stats(),
+            available_beds=self.hc.available_beds,
+            available_icu_units=self.hc.available_icu_units,
+            rng=self.random.get_state(),
+        )
+        return image
+
     cdef void set_problem(self, SimulationProblem problem, Person *p = NULL) nogil:
         self.problem = problem
         self.problem_person = p
@@ -1799,6 +2160,35 @@ cdef class Context:
         cdef str out = self._get_log_msg(s, person_idx)
         print(out)
 
+    def clone(self):
+        """Returns an independent copy of the context.
+
+        The disease parameters and the population indexes are shared with
+        the copy, so this is meant for cloning pristine contexts.
+        """
+        cdef Context other = Context.__new__(Context)
+
+        other.random = self.random.copy()
+        other.problem = self.problem
+        other.problem_person = NULL
+        other.disease = self.disease
+        other.pop = self.pop.copy()
+        other.hc = self.hc.copy()
+
+        other.start_date = self.start_date
+        other.day = self.day
+        other.interventions = list(self.interventions)
+        other.cross_border_mobility_factor = self.cross_border_mobility_factor
+
+        other.total_infectors = self.total_infectors
+        other.total_infections = self.total_infections
+        other.exposed_per_day = self.exposed_per_day
+
+        other.collect_timings = self.collect_timings
+        other._reset_timings()
+
+        return other
+
     def get_date_for_today(self):
         d = date.fromisoformat(self.start_date)
         return (d + timedelta(days=self.day)).isoformat()
@@ -1806,6 +2196,16 @@ cdef class Context:
     def add_intervention(self, iv):
         self.interventions.append(iv)
 
+    cdef void _reset_timings(self) nogil:
+        cdef int i
+
+        for i in range(NR_TIMING_PHASES):
+            self.phase_ns[i] = 0
+
+    def get_phase_timings(self):
+        """Returns the wall time (in ms) spent in each phase of the latest iteration"""
+        return {TIMING_PHASE_TO_STR[i]: self.phase_ns[i] / 1000000 for i in range(NR_TIMING_PHASES)}
+
     def generate_state(self):
         p = self.pop
         hc = self.hc
@@ -1850,6 +2250,9 @@ cdef class Context:
             daily_contacts[CONTACT_PLACE_TO_STR[i]] = self.pop.daily_contacts[i]
         s['daily_contacts'] = daily_contacts
 
+        if self.collect_timings:
+            s['phase_timings'] = self.get_phase_timings()
+
         return s
 
     def get_population_stats(self, what):
@@ -1977,16 +2380,34 @@ cdef class Context:
             self._process_person(person)
 
     cdef void _iterate(self):
+        cdef long long start_ns = 0, people_ns
+
+        if self.collect_timings:
+            start_ns = now_ns()
         self.pop.init_day(self)
         self.import_infections()
+        if self.collect_timings:
+            self.phase_ns[PHASE_INIT_DAY] = now_ns() - start_ns
 
         self.total_infectors = 0
         self.total_infections = 0
         self.exposed_per_day = 0
 
+        if self.collect_timings:
+            start_ns = now_ns()
         self.hc.iterate(self)
+        if self.collect_timings:
+            self.phase_ns[PHASE_HEALTHCARE] = now_ns() - start_ns
 
+        if self.collect_timings:
+            start_ns = now_ns()
         self._iterate_people()
+        if self.collect_timings:
+            # Contact sampling and exposures were accumulated per person,
+            # the rest is spent advancing the disease states.
+            people_ns = now_ns() - start_ns
+            self.phase_ns[PHASE_ADVANCE] = people_ns - self.phase_ns[PHASE_CONTACT_SAMPLING] \
+                - self.phase_ns[PHASE_EXPOSURE]
 
         #if self.get_date_for_today() == '2020-05-16':
         #    self.dump_state()
@@ -1994,10 +2415,17 @@ cdef class Context:
         self.day += 1
 
     def iterate(self):
+        cdef long long start_ns = 0
+
+        if self.collect_timings:
+            self._reset_timings()
+            start_ns = now_ns()
         today = self.get_date_for_today()
         for iv in self.interventions:
             if iv.date == today:
                 self.apply_intervention(iv)
+        if self.collect_timings:
+            self.phase_ns[PHASE_INTERVENTIONS] = now_ns() - start_ns
         self._iterate()
         if self.problem != SimulationProblem.NO_PROBLEMOS:
             raise SimulationFailed(PROBLEM_TO_STR[self.problem])
@@ -5,6 +5,8 @@ from numpy.random cimport bitgen_t
 cdef class RandomPool:
     cdef object gen
     cdef bitgen_t *rng
+    cdef _set_generator(self, gen)
+    cdef RandomPool copy(self)
     cdef double get(self) nogil
     cdef bint chance(self, double p) nogil
     cdef double lognormal(self, double mean, double sigma) nogil
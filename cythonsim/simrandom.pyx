@@ -13,7 +13,10 @@ from numpy.random.c_distributions cimport random_lognormal, random_gamma_f
 cdef class RandomPool:
     def __init__(self, seed):
         np.random.seed(seed)
-        self.gen = np.random.PCG64(seed)
+        self._set_generator(np.random.PCG64(seed))
+
+    cdef _set_generator(self, gen):
+        self.gen = gen
         capsule = self.gen.capsule
         # Optional check that the capsule if from a BitGenerator
         if not PyCapsule_IsValid(capsule, 'BitGenerator'):
@@ -21,6 +24,20 @@ cdef class RandomPool:
         # Cast the pointer
         self.rng = <bitgen_t *> PyCapsule_GetPointer(capsule, 'BitGenerator')
 
+    def get_state(self):
+        return self.gen.state
+
+    def set_state(self, state):
+        self.gen.state = state
+
+    cdef RandomPool copy(self):
+        """Returns a new pool that continues from the current state of this one"""
+        cdef RandomPool other = RandomPool.__new__(RandomPool)
+        gen = PCG64()
+        gen.state = self.gen.state
+        other._set_generator(gen)
+        return other
+
     cdef double get(self) nogil:
         cdef bitgen_t * rng = self.rng
         return rng.next_double(rng.state)
@@ -5,5 +5,13 @@ cd /app
 # Download updated mobility dataset
 python -m data_import.google_covid_mobility
 
+# Build the population image shared by all simulation processes
+python -m calc.population_images
+
+# Compute the results of the preset scenarios that are not stored yet. This
+# runs in the background, as a full run of every preset takes minutes; until
+# a result is stored, it is simulated on demand.
+nice python -m calc.precomputed_results &
+
 # Log to stdout
-exec gunicorn --access-logfile - -R -w 4 --bind 0.0.0.0:5000 graphql_backend:app 
+exec gunicorn -c gunicorn.conf.py --access-logfile - -R -w 4 --bind 0.0.0.0:5000 graphql_backend:app
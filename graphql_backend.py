@@ -1,9 +1,11 @@
 import traceback
-from flask import Flask
+from flask import Flask, Response, jsonify, request
 from flask_babel import Babel
 from flask_cors import CORS
 from flask_session import Session
+from common import cache_stats
 from graphql_schema import schema
+from simulation_events import open_event_stream
 from graphql_server.flask import GraphQLView
 
 
@@ -34,6 +36,34 @@ app.add_url_rule('/graphql', view_func=ReinaGraphQLView.as_view(
     graphiql=True,
 ))
 
+
+@app.route('/stats/cache')
+def cache_stats_view():
+    # The stats cover only the server process that handles the request
+    return jsonify(cache_stats.get_stats())
+
+
+@app.route('/simulation/<run_id>/events')
+def simulation_events_view(run_id):
+    # A reconnecting EventSource sends the id of the last event it received
+    since_index = request.headers.get('Last-Event-ID') or request.args.get('sinceIndex') or 0
+    try:
+        since_index = max(int(since_index), 0)
+    except ValueError:
+        return jsonify(dict(error='invalid sinceIndex')), 400
+
+    stream = open_event_stream(run_id, since_index)
+    if stream is None:
+        # The client falls back to polling simulationResults
+        return jsonify(dict(error='too many event streams')), 503, {'Retry-After': '10'}
+
+    return Response(
+        stream,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 app.config.from_object('common.settings')
 app.config['BABEL_TRANSLATION_DIRECTORIES'] = 'locale'
 
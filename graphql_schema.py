@@ -1,4 +1,6 @@
-from datetime import date, timedelta
+import threading
+import uuid
+from collections import OrderedDict
 import numpy as np
 from flask import session
 from graphene import (
@@ -7,14 +9,20 @@ from graphene import (
 )
 from graphql import GraphQLError
 
-from calc.datasets import get_detected_cases, get_population_for_area, get_mobility_data
+from calc.datasets import get_population_for_area
+from calc.metric_values import (
+    encode_values, get_mobility_change_values, get_validation_values, to_float_array, to_json_values,
+)
 from calc.simulation import get_age_grouped_population
-from common import cache
+from common import settings
 from common.interventions import (
     INTERVENTIONS, ChoiceParameter, IntParameter, get_intervention, get_active_interventions
 )
 from common.metrics import ALL_METRICS, METRICS, get_metric
-from simulation_thread import SimulationProcess
+from simulation_thread import (
+    PRIORITY_CUSTOM, PRIORITY_PRESET, SimulationProcess, estimate_run_eta, get_queue_position, get_run_results,
+    get_run_state, get_simulation_pool, leave_queued_run,
+)
 from variables import get_variable, reset_variables, set_variable, get_session_variables
 
 EventType = Enum(
@@ -23,6 +31,16 @@ EventType = Enum(
 
 MetricType = Enum('MetricType', [(m.id.upper().replace('-', '_'), m.id) for m in ALL_METRICS])
 
+# Metrics of the most recently polled run results by (run ID, results version, only)
+MAX_RUN_METRICS = 64
+_run_metrics = OrderedDict()
+_run_metrics_lock = threading.Lock()
+
+# The runs of the session that may still be queued or running, and the ID
+# the session waits for them with
+SESSION_RUNS_KEY = 'simulation_runs'
+SESSION_WAITER_KEY = 'simulation_waiter'
+
 
 class EventParameter(Interface):
     id = ID()
@@ -67,6 +85,17 @@ class CategorizedIntValues(ObjectType):
     values = List(List(Int))
 
 
+class EncodedValues(ObjectType):
+    # 'int32' or 'float32', little-endian
+    dtype = String(required=True)
+    shape = List(Int, required=True)
+    # Base64 of the values in row-major order
+    data = String(required=True)
+    # Base64 of a bitmap of the missing values, least significant bit first.
+    # Null if no values are missing.
+    null_bitmap = String()
+
+
 class Metric(ObjectType):
     type = MetricType(required=True)
     label = String(required=True)
@@ -79,6 +108,20 @@ class Metric(ObjectType):
     int_values = List(Int)
     float_values = List(Float)
     categorized_int_values = Field(CategorizedIntValues)
+    # The values of the metric in a compact form, for clients that opt in
+    encoded_values = Field(EncodedValues)
+
+    def resolve_encoded_values(parent, info):
+        # The NumPy array of the values is set as the `array` attribute
+        arr = getattr(parent, 'array', None)
+        if arr is None:
+            return None
+        # The metrics are memoized, so each one is encoded only once
+        encoded = getattr(parent, 'encoded', None)
+        if encoded is None:
+            is_integer = parent.is_integer or parent.is_categorized
+            encoded = parent.encoded = EncodedValues(**encode_values(arr, is_integer))
+        return encoded
 
 
 class DailyMetrics(ObjectType):
@@ -98,6 +141,12 @@ class SimulationResults(ObjectType):
     finished = Boolean(required=True)
     end_date = String(required=True)
     predicted_metrics = Field(DailyMetrics, required=True)
+    # Pass as `sinceIndex` in the next poll to get only the days after these
+    next_index = Int(required=True)
+    # Position in the queue of runs waiting for a free slot, or null if the run has started
+    queue_position = Int()
+    # Estimated seconds until the run finishes
+    eta_seconds = Float()
 
 
 class PopulationAgeGroup(ObjectType):
@@ -156,10 +205,12 @@ def iv_to_graphql_obj(iv, obj_id=None):
 
 
 def results_to_metrics(results, only=None):
+    # The results may be shared through the local cache, so the derived
+    # columns are kept separately instead of being added to the frame.
     df = results['total']
     adf = results['age_groups']
 
-    dates = df.index.astype(str).values
+    dates = df.index.astype(str).tolist()
 
     selected_metrics = []
     if only is None:
@@ -172,17 +223,18 @@ def results_to_metrics(results, only=None):
     metrics = []
 
     MIN_CASES = 20
-    df['ifr'] = df.dead.divide(
+    cols = {}
+    cols['ifr'] = df.dead.divide(
         df.all_infected.clip(lower=MIN_CASES).replace(MIN_CASES, np.inf)
     ) * 100
-    df['cfr'] = df.dead.divide(
+    cols['cfr'] = df.dead.divide(
         df.all_detected.clip(lower=MIN_CASES).replace(MIN_CASES, np.inf)
     ) * 100
-    df['ifr'] = df['ifr'].rolling(window=7).mean()
-    df['cfr'] = df['cfr'].rolling(window=7).mean()
-    df['r'] = df['r'].rolling(window=7).mean()
-    df['new_infections'] = df['new_infections'].rolling(window=14).mean().round().astype('Int64').replace({np.nan: None})
-    df['detected'] = df['detected'].rolling(window=14).mean().round().astype('Int64').replace({np.nan: None})
+    cols['ifr'] = cols['ifr'].rolling(window=7).mean()
+    cols['cfr'] = cols['cfr'].rolling(window=7).mean()
+    cols['r'] = df['r'].rolling(window=7).mean()
+    cols['new_infections'] = df['new_infections'].rolling(window=14).mean().round()
+    cols['detected'] = df['detected'].rolling(window=14).mean().round()
 
     for m in selected_metrics:
         int_values = None
@@ -193,43 +245,107 @@ def results_to_metrics(results, only=None):
             if adf is None:
                 continue
             s = adf[m.id]
-            categorized_int_values = CategorizedIntValues(categories=s.columns, values=s.values)
+            arr = s.values
+            categorized_int_values = CategorizedIntValues(categories=list(s.columns), values=arr.tolist())
         else:
-            if m.id not in df.columns:
-                raise Exception('metric %s not found in dataset' % m.id())
-            vals = df[m.id]
+            if m.id in cols:
+                vals = cols[m.id]
+            elif m.id in df.columns:
+                vals = df[m.id]
+            else:
+                raise Exception('metric %s not found in dataset' % m.id)
+            arr = to_float_array(vals)
             if m.is_integer:
-                int_values = vals.astype('Int32').replace({np.nan: None})
+                int_values = to_json_values(arr, True)
             else:
-                vals = vals.astype('float')
-                float_values = vals.replace({np.nan: None})
-
-        metrics.append(
-            Metric(
-                type=m.id,
-                label=m.label,
-                description=m.description,
-                unit=m.unit,
-                color=m.color,
-                is_integer=m.is_integer,
-                is_simulated=m.is_simulated,
-                is_categorized=m.is_categorized,
-                int_values=int_values,
-                float_values=float_values,
-                categorized_int_values=categorized_int_values,
-            )
+                float_values = to_json_values(arr, False)
+
+        metric = Metric(
+            type=m.id,
+            label=m.label,
+            description=m.description,
+            unit=m.unit,
+            color=m.color,
+            is_integer=m.is_integer,
+            is_simulated=m.is_simulated,
+            is_categorized=m.is_categorized,
+            int_values=int_values,
+            float_values=float_values,
+            categorized_int_values=categorized_int_values,
         )
+        metric.array = arr
+        metrics.append(metric)
 
     return (dates, metrics)
 
 
+def _slice(values, start, end):
+    if values is None:
+        return None
+    return values[start:end]
+
+
+def slice_metrics(dates, metrics, start, end):
+    """Returns the dates and the metrics of the days from `start` up to `end`"""
+
+    out = []
+    for m in metrics:
+        civ = m.categorized_int_values
+        if civ is not None:
+            civ = CategorizedIntValues(categories=civ.categories, values=civ.values[start:end])
+        metric = Metric(
+            type=m.type,
+            label=m.label,
+            description=m.description,
+            unit=m.unit,
+            color=m.color,
+            is_integer=m.is_integer,
+            is_simulated=m.is_simulated,
+            is_categorized=m.is_categorized,
+            int_values=_slice(m.int_values, start, end),
+            float_values=_slice(m.float_values, start, end),
+            categorized_int_values=civ,
+        )
+        metric.array = _slice(getattr(m, 'array', None), start, end)
+        out.append(metric)
+    return (dates[start:end], out)
+
+
+def get_run_metrics(run_id, version, results, only=None):
+    """Returns results_to_metrics() of the results of a run, computed once per results version.
+
+    `results` is called to get the results on a miss. The number of days
+    simulated so far is returned as the third item.
+    """
+    key = (run_id, version, tuple(only) if only is not None else None)
+    with _run_metrics_lock:
+        ret = _run_metrics.get(key)
+        if ret is not None:
+            _run_metrics.move_to_end(key)
+            return ret
+
+    results = results()
+    if results is None:
+        # The run expired in the meantime
+        return ([], [], 0)
+
+    # Days that have not been simulated yet have no values
+    nr_days = int(results['total']['susceptible'].count())
+    ret = results_to_metrics(results, only) + (nr_days,)
+    with _run_metrics_lock:
+        _run_metrics[key] = ret
+        while len(_run_metrics) > MAX_RUN_METRICS:
+            _run_metrics.popitem(last=False)
+    return ret
+
+
 simulation_processes = {}
 
 
 class Query(ObjectType):
     available_events = List(Event)
     active_events = List(Event)
-    simulation_results = Field(SimulationResults, run_id=ID(required=True))
+    simulation_results = Field(SimulationResults, run_id=ID(required=True), since_index=Int())
     validation_metrics = Field(DailyMetrics)
     scenarios = List(Scenario)
     mobility_change_metrics = Field(DailyMetrics)
@@ -250,11 +366,13 @@ class Query(ObjectType):
             out.append(obj)
         return out
 
-    def resolve_simulation_results(query, info, run_id):
-        cache_key = '%s-finished' % run_id
-        finished = cache.get(cache_key)
-        if finished is None:
+    def resolve_simulation_results(query, info, run_id, since_index=None):
+        state = get_run_state(
+            run_id, fields=('finished', 'error', 'version', 'queued', 'started_at', 'total_days')
+        )
+        if state is None or state.get('finished') is None:
             raise GraphQLError('No simulation run active')
+        finished = state['finished']
 
         if finished and run_id in simulation_processes:
             print('Process %s finished, joining' % run_id)
@@ -265,36 +383,45 @@ class Query(ObjectType):
             simulation_processes[run_id].join()
             del simulation_processes[run_id]
 
-        error = cache.get('%s-error' % run_id)
+        error = state.get('error')
         if error is not None:
             raise GraphQLError('Simulation error: %s' % error)
 
-        results = cache.get('%s-results' % run_id)
-        if results is not None:
-            dates, metrics = results_to_metrics(results)
+        version = state.get('version')
+        if version is not None:
+            # Identical polls only look up the metrics, the results are fetched on a miss
+            dates, metrics, nr_days = get_run_metrics(run_id, version, lambda: get_run_results(run_id))
         else:
             dates = []
             metrics = []
+            nr_days = 0
+
+        if since_index is not None:
+            # Only the days simulated so far are returned, as their values do
+            # not change anymore. The rolling means are computed over the
+            # whole run, so the first days of the slice include the days
+            # before it.
+            start = max(0, min(since_index, nr_days))
+            dates, metrics = slice_metrics(dates, metrics, start, nr_days)
+
+        # Only queued runs need the extra round trip for the position
+        queue_position = get_queue_position(run_id) if state.get('queued') and not finished else None
+        eta_seconds = estimate_run_eta(state, queue_position, nr_days)
 
         daily_metrics = DailyMetrics(dates=dates, metrics=metrics)
-        return SimulationResults(run_id=run_id, finished=finished, predicted_metrics=daily_metrics)
+        return SimulationResults(
+            run_id=run_id, finished=finished, predicted_metrics=daily_metrics, next_index=nr_days,
+            queue_position=queue_position, eta_seconds=eta_seconds,
+        )
 
     def resolve_validation_metrics(query, info):
-        df = get_detected_cases()
-        sim_start = date.fromisoformat(get_variable('start_date'))
-        sim_end = sim_start + timedelta(days=get_variable('simulation_days'))
-        df = df[df.index < sim_end]
-        df['detected'] = df['all_detected'].diff()
-        df['detected'] = df['detected'].rolling(window=14).mean().round().astype('Int64').replace({np.nan: None})
-        dates = df.index.astype(str).values
+        payload = get_validation_values()
 
         metrics = []
-
-        for col in df.columns:
+        for col, values in payload['values'].items():
             m = get_metric(col)
             if not m:
                 raise Exception('no metric found for %s' % col)
-            int_values = df[col].to_numpy()
             metrics.append(
                 Metric(
                     type=m.id,
@@ -304,21 +431,17 @@ class Query(ObjectType):
                     color=m.color,
                     is_integer=m.is_integer,
                     is_simulated=False,
-                    int_values=int_values
+                    int_values=values,
                 )
             )
-        return DailyMetrics(dates=dates, metrics=metrics)
+            metrics[-1].array = payload['arrays'][col]
+        return DailyMetrics(dates=payload['dates'], metrics=metrics)
 
     def resolve_mobility_change_metrics(self, info):
-        df = get_mobility_data().rolling(7).mean().round().dropna(how='all')
-        df = df.astype('Int32').replace({np.nan: None})
+        payload = get_mobility_change_values()
 
         metrics = []
-        dates = list(df.index.astype(str).values)
-
-        for col in df:
-            s = df[col]
-
+        for col, values in payload['values'].items():
             m = get_metric('%s_mobility_change' % col)
             m_obj = Metric(
                 type=m.id,
@@ -328,11 +451,12 @@ class Query(ObjectType):
                 color=m.color,
                 is_integer=m.is_integer,
                 is_simulated=False,
-                int_values=s.values,
+                int_values=values,
             )
+            m_obj.array = payload['arrays'][col]
             metrics.append(m_obj)
 
-        return DailyMetrics(dates=dates, metrics=metrics)
+        return DailyMetrics(dates=payload['dates'], metrics=metrics)
 
     def resolve_area(query, info):
         name = get_variable('area_name')
@@ -369,6 +493,37 @@ class Query(ObjectType):
         return out
 
 
+def get_session_waiter():
+    waiter = session.get(SESSION_WAITER_KEY)
+    if waiter is None:
+        waiter = session[SESSION_WAITER_KEY] = uuid.uuid4().hex
+    return waiter
+
+
+def limit_session_runs():
+    """Makes room for a new run of the session.
+
+    If the session already has the maximum number of runs queued or
+    running, it stops waiting for its oldest queued run. The run itself is
+    cancelled only if no other session waits for it.
+    """
+    runs = []
+    for run_id in session.get(SESSION_RUNS_KEY, []):
+        state = get_run_state(run_id, fields=('finished',))
+        if state is not None and state.get('finished') is False:
+            runs.append(run_id)
+
+    while len(runs) >= settings.SIMULATION_SESSION_MAX_RUNS:
+        for run_id in runs:
+            if leave_queued_run(run_id, get_session_waiter()):
+                runs.remove(run_id)
+                break
+        else:
+            raise GraphQLError('Too many simulations running')
+
+    session[SESSION_RUNS_KEY] = runs
+
+
 class RunSimulation(Mutation):
     class Arguments:
         random_seed = Int()
@@ -377,9 +532,30 @@ class RunSimulation(Mutation):
 
     def mutate(root, info, random_seed=None):
         variables = session.copy()
+        variables.pop(SESSION_RUNS_KEY, None)
+        variables.pop(SESSION_WAITER_KEY, None)
         if random_seed is not None:
             variables['random_seed'] = random_seed
 
+        pool = get_simulation_pool()
+        if pool is not None:
+            if pool.is_full():
+                raise GraphQLError('System busy')
+
+            customized_variables = set(get_session_variables().keys()) - {'active_scenario'}
+            # Runs of the preset scenarios are often cached or precomputed,
+            # so they go ahead of customized runs.
+            if not customized_variables and random_seed is None:
+                priority = PRIORITY_PRESET
+            else:
+                priority = PRIORITY_CUSTOM
+
+            limit_session_runs()
+            run_id = pool.submit(variables, priority=priority, waiter=get_session_waiter())
+            if run_id not in session[SESSION_RUNS_KEY]:
+                session[SESSION_RUNS_KEY] = session[SESSION_RUNS_KEY] + [run_id]
+            return dict(run_id=run_id)
+
         for key, process in list(simulation_processes.items()):
             if process.exitcode is not None:
                 process.join()
@@ -0,0 +1,17 @@
+import os
+
+# Load the app in the master process and warm it up before the workers are
+# forked, so that the workers share the loaded datasets copy-on-write. The
+# simulation worker pool warms up separately, see calc/warmup.py.
+preload_app = True
+
+# The simulation event streams keep their connection open for the duration
+# of the run, so each worker serves requests in several threads.
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+
+def when_ready(server):
+    from calc.warmup import warm_up
+
+    ms = warm_up()
+    server.log.info('Warmup finished in %.0f ms' % ms)
@@ -0,0 +1,130 @@
+"""Server-Sent Events stream of the progress of a simulation run.
+
+The stream pushes the metrics of the newly simulated days whenever the run
+publishes new results, so clients do not need to poll simulationResults.
+Each `progress` event has the id of the index to continue from, so a
+reconnecting EventSource resumes where it left off.
+"""
+import json
+import threading
+import time
+
+from common import cache, settings
+from graphql_schema import get_run_metrics, slice_metrics
+from simulation_thread import get_run_channel, get_run_results, get_run_state
+
+# Connections are closed after this long, the clients reconnect
+MAX_STREAM_DURATION = 600
+KEEPALIVE_INTERVAL = 15
+# Without a shared pub/sub, runs in other processes are checked this often
+LOCAL_CHECK_INTERVAL = 1
+
+# Each open stream holds a request thread, so only some of the threads of a
+# server process may serve them.
+_stream_slots = threading.BoundedSemaphore(settings.SIMULATION_MAX_EVENT_STREAMS)
+
+
+def format_event(event, data, event_id=None):
+    out = 'event: %s\n' % event
+    if event_id is not None:
+        out += 'id: %s\n' % event_id
+    return out + 'data: %s\n\n' % json.dumps(data)
+
+
+def metric_to_json(m):
+    civ = m.categorized_int_values
+    if civ is not None:
+        civ = dict(categories=civ.categories, values=civ.values)
+    return dict(
+        type=m.type,
+        label=m.label,
+        description=m.description,
+        unit=m.unit,
+        color=m.color,
+        isInteger=m.is_integer,
+        isSimulated=m.is_simulated,
+        isCategorized=m.is_categorized,
+        intValues=m.int_values,
+        floatValues=m.float_values,
+        categorizedIntValues=civ,
+    )
+
+
+def stream_simulation_results(run_id, since_index=0):
+    """Yields the events of the run until it finishes"""
+
+    # Subscribe before reading the state, so that no update is missed
+    subscription = cache.subscribe(get_run_channel(run_id))
+    try:
+        started_at = last_sent_at = time.monotonic()
+        last_version = None
+        next_index = since_index
+        while True:
+            state = get_run_state(run_id, fields=('finished', 'error', 'version'))
+            if state is None or state.get('finished') is None:
+                yield format_event('error', dict(message='No simulation run active'))
+                return
+            if state.get('error') is not None:
+                yield format_event('error', dict(message='Simulation error: %s' % state['error']))
+                return
+
+            version = state.get('version')
+            if version is not None and version != last_version:
+                last_version = version
+                dates, metrics, nr_days = get_run_metrics(run_id, version, lambda: get_run_results(run_id))
+                if nr_days > next_index:
+                    dates, metrics = slice_metrics(dates, metrics, next_index, nr_days)
+                    data = dict(
+                        runId=run_id, sinceIndex=next_index, nextIndex=nr_days, dates=dates,
+                        metrics=[metric_to_json(m) for m in metrics],
+                    )
+                    yield format_event('progress', data, event_id=nr_days)
+                    next_index = nr_days
+                    last_sent_at = time.monotonic()
+
+            if state['finished']:
+                yield format_event('finished', dict(runId=run_id, nextIndex=next_index))
+                return
+
+            now = time.monotonic()
+            if now - started_at > MAX_STREAM_DURATION:
+                return
+            if now - last_sent_at > KEEPALIVE_INTERVAL:
+                yield ': keepalive\n\n'
+                last_sent_at = now
+
+            if subscription.is_shared:
+                subscription.wait(KEEPALIVE_INTERVAL)
+            else:
+                subscription.wait(LOCAL_CHECK_INTERVAL)
+    finally:
+        subscription.close()
+
+
+class EventStream:
+    """The events of a run as a response body that frees its stream slot when closed"""
+
+    def __init__(self, run_id, since_index):
+        self.events = stream_simulation_results(run_id, since_index)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.events)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.events.close()
+        _stream_slots.release()
+
+
+def open_event_stream(run_id, since_index=0):
+    """Returns the event stream of the run, or None if the process serves too many streams already"""
+
+    if not _stream_slots.acquire(blocking=False):
+        return None
+    return EventStream(run_id, since_index)
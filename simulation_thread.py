@@ -1,61 +1,532 @@
 import logging
 import multiprocessing
+import os
+import resource
+import socket
+import threading
 import time
 import uuid
 
 from calc import ExecutionInterrupted
 from calc.simulation import simulate_individuals
 from calc.utils import generate_cache_key
-from common import cache
+from calc.warmup import warm_up
+from common import cache, settings
 
 logger = logging.getLogger(__name__)
 
+# The server processes handle requests in several threads, and a process
+# forked from one of them may inherit a lock held by another thread. The
+# simulation processes are therefore forked from a single-threaded fork
+# server that has imported this module.
+_mp_context = multiprocessing.get_context('forkserver')
+_mp_context.set_forkserver_preload([__name__])
+
+# The state of a finished run is kept this long
+CACHE_EXPIRATION = 30
+# The state of a run that has not finished is kept this long after its last
+# update, as it may wait in the queue and take a while to produce its first day
+ACTIVE_RUN_EXPIRATION = 3600
+# A run whose claim is not refreshed for this long is considered dead
+CLAIM_TIMEOUT = 60
+
+# The queue of runs shared by all the server processes, and the channel that
+# is notified when a run is queued or a slot is released
+QUEUE_NAME = 'simulation-queue'
+QUEUE_CHANNEL = 'simulation-queue-events'
+# Idle workers check the queue at least this often (in seconds)
+QUEUE_WAIT_INTERVAL = 5
+# The pool replaces exited workers this often (in seconds)
+POOL_MAINTAIN_INTERVAL = 5
+
+PRIORITY_PRESET = 0
+PRIORITY_CUSTOM = 1
+
+# Moving average of the run durations, for estimating the time to finish.
+# Processes use their local copy of it for this long before checking it again.
+RUN_DURATION_KEY = 'simulation-run-duration'
+RUN_DURATION_LOCAL_TIMEOUT = 60
+DEFAULT_RUN_DURATION = 30
+
+
+def get_claim_key(cache_key):
+    return '%s-claim' % cache_key
+
+
+def get_run_key(cache_key):
+    return '%s-run' % cache_key
+
+
+def get_waiters_key(run_id):
+    return '%s-waiters' % run_id
+
+
+def get_run_channel(run_id):
+    """Returns the channel that is notified whenever the state of the run changes"""
+
+    return '%s-events' % run_id
+
+
+def get_run_state(run_id, fields=None):
+    """Returns the state of the run as a dict or None if there is no such run.
+
+    The state has the fields `finished`, `error`, `results` and `version`,
+    which changes whenever the results do. They are read in a single cache
+    round trip; with `fields`, only the given fields are read.
+    """
+    return cache.get_record(get_run_key(run_id), fields)
+
+
+def get_run_results(run_id):
+    state = get_run_state(run_id, fields=('results',))
+    if state is None:
+        return None
+    return state.get('results')
+
+
+def update_run_state(cache_key, timeout=CACHE_EXPIRATION, **fields):
+    cache.update_record(get_run_key(cache_key), timeout=timeout, channel=get_run_channel(cache_key), **fields)
+
+
+def run_simulation(log_id, cache_key, variables, started_at, owner, slot=None):
+    """Runs the simulation claimed by `owner` and publishes its progress under `cache_key`.
+
+    `slot` is a (key, owner) pair of the simulation slot the run holds.
+    """
+
+    last_results = None
+    first_day = True
+    logger.info('%s: run simulation (cache key %s)' % (log_id, cache_key))
+
+    def step_callback(total, age_groups=None, force=False):
+        nonlocal last_results, first_day
+
+        now = time.time()
+        if first_day:
+            logger.info('%s: time to first day %.0f ms' % (log_id, (now - started_at) * 1000))
+            first_day = False
+
+        res = dict(total=total, age_groups=age_groups)
+        if force or last_results is None or now - last_results > 0.5:
+            logger.debug('%s: set results to %s' % (log_id, cache_key))
+            update_run_state(cache_key, timeout=ACTIVE_RUN_EXPIRATION, results=res, version=uuid.uuid4().hex)
+            cache.claim(get_claim_key(cache_key), CLAIM_TIMEOUT, owner)
+            if slot is not None:
+                cache.claim(slot[0], CLAIM_TIMEOUT, slot[1])
+            last_results = now
+
+        return True
+
+    try:
+        df, adf = simulate_individuals(step_callback=step_callback, variable_store=variables)
+    except ExecutionInterrupted:
+        logger.error('%s: simulation cancelled' % log_id)
+    except Exception as e:
+        update_run_state(cache_key, finished=True, error=str(e))
+        cache.release_claim(get_claim_key(cache_key), owner)
+        raise
+    else:
+        logger.info('%s: computation finished' % log_id)
+        step_callback(df, age_groups=adf, force=True)
+
+    update_run_state(cache_key, finished=True)
+    # The finished marker keeps identical runs from starting while the results are cached
+    cache.release_claim(get_claim_key(cache_key), owner)
+
+
+def publish_cached_results(cache_key, variables):
+    """Publishes the results of the run right away if they are cached or precomputed"""
+
+    results = simulate_individuals(only_if_in_cache=True, variable_store=variables)
+    if results is None:
+        return False
+
+    df, adf = results
+    update_run_state(
+        cache_key, results=dict(total=df, age_groups=adf), version=uuid.uuid4().hex, error=None, finished=True
+    )
+    return True
+
+
+def claim_run(cache_key, owner, variables):
+    """Claims the run for `owner`.
+
+    Returns False if an identical run is already active or has just finished,
+    or if its results are already available, in which case the caller reads
+    the progress of that run instead.
+    """
+    if publish_cached_results(cache_key, variables):
+        return False
+
+    claimed, holder = cache.claim(get_claim_key(cache_key), CLAIM_TIMEOUT, owner)
+    if not claimed:
+        return False
+    state = get_run_state(cache_key, fields=('finished', 'error'))
+    # Failed and cancelled runs may be started again
+    if state is not None and state.get('finished') and state.get('error') is None:
+        cache.release_claim(get_claim_key(cache_key), owner)
+        return False
+
+    update_run_state(cache_key, timeout=ACTIVE_RUN_EXPIRATION, error=None, finished=False)
+    return True
+
+
+class SimulationProcess(_mp_context.Process):
+    """Runs a single simulation in a freshly forked process"""
 
-class SimulationProcess(multiprocessing.Process):
     def __init__(self, variables):
         self.variables = variables
         super().__init__(daemon=True)
         self.uuid = str(uuid.uuid4())
         self.cache_key = generate_cache_key(simulate_individuals, var_store=self.variables)
-        self.cache_expiration = 30
+        self.started_at = None
 
     def start(self):
         logger.info('%s: start process' % self.uuid)
-        finished = cache.get('%s-finished' % self.cache_key)
-        if finished is not None:
+        if not claim_run(self.cache_key, self.uuid, self.variables):
             logger.info('%s: already running in another process (%s)' % (self.uuid, self.cache_key))
             return
-        # Race condition here, but it is of little consequence
-        # FIXME: Probably should use SETNX instead
-        cache.set('%s-error' % self.cache_key, None, self.cache_expiration)
-        cache.set('%s-finished' % self.cache_key, False, timeout=self.cache_expiration)
+        self.started_at = time.time()
         super().start()
 
     def run(self):
-        self.last_results = None
-        logger.info('%s: run process (cache key %s)' % (self.uuid, self.cache_key))
+        run_simulation(self.uuid, self.cache_key, self.variables, self.started_at, self.uuid)
+        logger.info('%s: process finished' % self.uuid)
+
+
+def get_slot_count():
+    """Returns the number of simulations that may run at the same time on this host"""
+
+    if settings.SIMULATION_MAX_CONCURRENCY > 0:
+        return settings.SIMULATION_MAX_CONCURRENCY
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def acquire_slot(owner):
+    """Claims one of the simulation slots of this host. Returns its key or None if all are taken."""
+
+    host = socket.gethostname()
+    for idx in range(get_slot_count()):
+        key = 'simulation-slot-%s-%d' % (host, idx)
+        claimed, holder = cache.claim(key, CLAIM_TIMEOUT, owner)
+        if claimed:
+            return key
+    return None
+
+
+def release_slot(key, owner):
+    cache.release_claim(key, owner)
+    # Wake up the workers waiting for a slot
+    cache.publish(QUEUE_CHANNEL, key)
+
+
+def get_queue_score(priority, submitted_at):
+    # Lower scores are run first, and jobs of the same priority in the order they came in
+    return priority * 1e10 + submitted_at
+
+
+def queue_run(cache_key, variables, owner, priority):
+    """Adds the claimed run to the shared queue"""
+
+    submitted_at = time.time()
+    job = dict(variables=dict(variables), owner=owner, submitted_at=submitted_at)
+    # The run state outlives the claim while the job waits in the queue
+    update_run_state(cache_key, timeout=ACTIVE_RUN_EXPIRATION, job=job, queued=True, started_at=None)
+    cache.queue_push(QUEUE_NAME, cache_key, get_queue_score(priority, submitted_at))
+    cache.publish(QUEUE_CHANNEL, cache_key)
+
+
+def cancel_queued_run(cache_key, reason):
+    """Removes the run from the queue if it has not started yet. Returns True if it was removed."""
+
+    if not cache.queue_remove(QUEUE_NAME, cache_key):
+        return False
+    state = get_run_state(cache_key, fields=('job',))
+    update_run_state(cache_key, finished=True, error=reason, job=None, queued=False)
+    if state is not None and state.get('job') is not None:
+        cache.release_claim(get_claim_key(cache_key), state['job']['owner'])
+    return True
+
 
-        def step_callback(total, age_groups=None, force=False):
-            now = time.time()
-            res = dict(total=total, age_groups=age_groups)
-            if force or self.last_results is None or now - self.last_results > 0.5:
-                logger.debug('%s: set results to %s' % (self.uuid, self.cache_key))
-                cache.set('%s-results' % self.cache_key, res, timeout=self.cache_expiration)
-                self.last_results = now
+def add_run_waiter(run_id, waiter):
+    """Records that `waiter` (e.g. a session) waits for the results of the run"""
 
-            return True
+    cache.set_add(get_waiters_key(run_id), waiter, timeout=ACTIVE_RUN_EXPIRATION)
 
+
+def leave_queued_run(run_id, waiter):
+    """Stops `waiter` from waiting for the run if it has not started yet.
+
+    Identical runs are coalesced, so the run is cancelled only if nobody else
+    waits for it. Returns False if the run is not queued.
+    """
+    if cache.queue_rank(QUEUE_NAME, run_id) is None:
+        return False
+    if not cache.set_remove(get_waiters_key(run_id), waiter):
+        cancel_queued_run(run_id, 'Cancelled by a newer simulation request')
+    return True
+
+
+def pop_job():
+    """Takes the next job from the shared queue. Returns None if the queue is empty."""
+
+    while True:
+        cache_key = cache.queue_pop(QUEUE_NAME)
+        if cache_key is None:
+            return None
+        state = get_run_state(cache_key, fields=('job',))
+        if state is None or state.get('job') is None:
+            # The run has expired while queued
+            continue
+        return dict(state['job'], cache_key=cache_key)
+
+
+def get_queue_position(run_id):
+    """Returns the 1-based position of the run in the queue, or None if it is not queued"""
+
+    rank = cache.queue_rank(QUEUE_NAME, run_id)
+    if rank is None:
+        return None
+    return rank + 1
+
+
+def record_run_duration(seconds):
+    avg = cache.get(RUN_DURATION_KEY)
+    if avg is not None:
+        seconds = avg * 0.8 + seconds * 0.2
+    cache.set(RUN_DURATION_KEY, seconds, timeout=24 * 3600, local_timeout=RUN_DURATION_LOCAL_TIMEOUT)
+
+
+def estimate_run_eta(state, queue_position, nr_days):
+    """Returns the estimated number of seconds until the run finishes, or None if it is not known.
+
+    `state` is the run state with the fields `finished`, `started_at` and
+    `total_days`, and `nr_days` the number of days simulated so far.
+    """
+
+    if state.get('finished'):
+        return 0
+
+    started_at = state.get('started_at')
+    total_days = state.get('total_days')
+    if queue_position is None and started_at is not None and nr_days and total_days:
+        elapsed = time.time() - started_at
+        return elapsed / nr_days * (total_days - nr_days)
+
+    # The average is mostly served from the local cache, see record_run_duration()
+    avg = cache.get(RUN_DURATION_KEY) or DEFAULT_RUN_DURATION
+    if queue_position is not None:
+        # The runs ahead in the queue share the slots, and then this one runs
+        return ((queue_position - 1) / get_slot_count() + 1) * avg
+    if started_at is None:
+        return None
+    return max(avg - (time.time() - started_at), 0)
+
+
+class SimulationWorker(_mp_context.Process):
+    """A long-lived process that runs simulation jobs from the shared queue.
+
+    A job is taken only when one of the slots of the host is free, so the
+    number of simulations running at the same time is bounded by the CPUs
+    and not by the number of workers. The worker exits after `max_jobs` jobs
+    or when its peak memory use exceeds `max_memory_mb`, and the pool
+    replaces it with a fresh one.
+    """
+
+    def __init__(self, stop, max_jobs, max_memory_mb):
+        super().__init__(daemon=True)
+        self.stop = stop
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+
+    def get_memory_usage_mb(self):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def take_job(self, slot_owner):
+        """Returns a (job, slot) pair, or None if there is no job or no free slot"""
+
+        if not cache.queue_length(QUEUE_NAME):
+            return None
+        slot = acquire_slot(slot_owner)
+        if slot is None:
+            return None
+        job = pop_job()
+        if job is None:
+            release_slot(slot, slot_owner)
+            return None
+        return (job, slot)
+
+    def run_job(self, log_id, job, slot, slot_owner):
+        cache_key = job['cache_key']
+        # If the job waited in the queue longer than the claim lives, an
+        # identical run may have been started elsewhere in the meantime.
+        claimed, holder = cache.claim(get_claim_key(cache_key), CLAIM_TIMEOUT, job['owner'])
+        if not claimed:
+            logger.info('%s: run %s taken over by %s' % (log_id, cache_key, holder))
+            return
+
+        started_at = time.time()
+        logger.info('%s: run %s waited %.0f ms in the queue' % (
+            log_id, cache_key, (started_at - job['submitted_at']) * 1000
+        ))
+        update_run_state(
+            cache_key, timeout=ACTIVE_RUN_EXPIRATION, finished=False, queued=False, started_at=started_at,
+            total_days=job['variables'].get('simulation_days'),
+        )
         try:
-            df, adf = simulate_individuals(step_callback=step_callback, variable_store=self.variables)
-        except ExecutionInterrupted:
-            logger.error('%s: process cancelled' % self.uuid)
-        except Exception as e:
-            cache.set('%s-finished' % self.cache_key, True, self.cache_expiration)
-            cache.set('%s-error' % self.cache_key, str(e), self.cache_expiration)
-            raise
+            run_simulation(
+                log_id, cache_key, job['variables'], job['submitted_at'], job['owner'], slot=(slot, slot_owner)
+            )
+        except Exception:
+            logger.exception('%s: simulation failed' % log_id)
         else:
-            logger.info('%s: computation finished' % self.uuid)
-            step_callback(df, age_groups=adf, force=True)
+            record_run_duration(time.time() - started_at)
 
-        cache.set('%s-finished' % self.cache_key, True, self.cache_expiration)
-        logger.info('%s: process finished' % self.uuid)
+    def run(self):
+        log_id = 'worker %d' % self.pid
+        ms = warm_up()
+        logger.info('%s: ready, cold start took %.0f ms' % (log_id, ms))
+
+        slot_owner = str(uuid.uuid4())
+        subscription = cache.subscribe(QUEUE_CHANNEL)
+        nr_jobs = 0
+        try:
+            while nr_jobs < self.max_jobs and not self.stop.is_set():
+                ret = self.take_job(slot_owner)
+                if ret is None:
+                    # Woken up when a job is queued or a slot is released
+                    subscription.wait(QUEUE_WAIT_INTERVAL)
+                    continue
+
+                job, slot = ret
+                nr_jobs += 1
+                try:
+                    self.run_job(log_id, job, slot, slot_owner)
+                finally:
+                    release_slot(slot, slot_owner)
+
+                if self.get_memory_usage_mb() > self.max_memory_mb:
+                    logger.info('%s: memory limit exceeded, recycling' % log_id)
+                    break
+        finally:
+            subscription.close()
+
+        logger.info('%s: exiting after %d jobs' % (log_id, nr_jobs))
+
+
+class SimulationPool:
+    """The simulation workers of this server process.
+
+    The workers of all the server processes take their jobs from the same
+    queue in the cache, so the admission of runs is shared between them.
+    """
+
+    def __init__(self, nr_workers, max_jobs_per_worker, max_worker_memory_mb):
+        self.nr_workers = nr_workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_worker_memory_mb = max_worker_memory_mb
+        self.stop = _mp_context.Event()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.maintainer = None
+
+    def start(self):
+        """Starts the workers and a thread that replaces them when they exit"""
+
+        self.maintain()
+        self.maintainer = threading.Thread(target=self.run_maintainer, daemon=True)
+        self.maintainer.start()
+
+    def run_maintainer(self):
+        while not self.stop.wait(POOL_MAINTAIN_INTERVAL):
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception('Maintaining the simulation pool failed')
+
+    def maintain(self):
+        """Replaces the workers that have exited"""
+
+        with self.lock:
+            for worker in self.workers:
+                if worker.exitcode is not None:
+                    worker.join()
+            self.workers = [w for w in self.workers if w.exitcode is None]
+
+            while len(self.workers) < self.nr_workers and not self.stop.is_set():
+                worker = SimulationWorker(self.stop, self.max_jobs_per_worker, self.max_worker_memory_mb)
+                worker.start()
+                logger.info('Started simulation worker with PID %s' % worker.pid)
+                self.workers.append(worker)
+
+    def is_full(self):
+        return cache.queue_length(QUEUE_NAME) >= settings.SIMULATION_MAX_QUEUED
+
+    def submit(self, variables, priority=PRIORITY_CUSTOM, waiter=None):
+        """Queues a simulation run and returns its run ID.
+
+        Identical runs are coalesced: if the same run is already active or
+        queued, its run ID is returned without queueing a new job. `waiter`
+        is recorded as waiting for the run, see leave_queued_run().
+        """
+        cache_key = generate_cache_key(simulate_individuals, var_store=variables)
+        if waiter is not None:
+            # Before the claim, so that the run is not cancelled under the waiter
+            add_run_waiter(cache_key, waiter)
+        owner = str(uuid.uuid4())
+        if claim_run(cache_key, owner, variables):
+            queue_run(cache_key, variables, owner, priority)
+        else:
+            logger.info('Joining active run %s' % cache_key)
+        return cache_key
+
+    def shutdown(self):
+        self.stop.set()
+        if self.maintainer is not None:
+            self.maintainer.join()
+        with self.lock:
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+
+_pool = None
+
+
+_pool_lock = threading.Lock()
+_pool_unavailable_logged = False
+
+
+def get_simulation_pool(create=True):
+    """Returns the worker pool of this process.
+
+    Returns None if there is no pool: SIMULATION_WORKERS is 0, or the cache
+    is not shared between processes, in which case the workers would not see
+    the runs queued by the server process. The caller then starts a process
+    per run instead.
+    """
+    global _pool, _pool_unavailable_logged
+
+    if settings.SIMULATION_WORKERS <= 0:
+        return None
+
+    with _pool_lock:
+        if _pool is None and create:
+            if not cache.is_shared():
+                if not _pool_unavailable_logged:
+                    logger.warning(
+                        'The simulation workers need Redis as the cache (set REDIS_URL), '
+                        'starting a process per run instead'
+                    )
+                    _pool_unavailable_logged = True
+                return None
+            _pool = SimulationPool(
+                nr_workers=settings.SIMULATION_WORKERS,
+                max_jobs_per_worker=settings.SIMULATION_WORKER_MAX_JOBS,
+                max_worker_memory_mb=settings.SIMULATION_WORKER_MAX_MEMORY_MB,
+            )
+            _pool.start()
+    return _pool
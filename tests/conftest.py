@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from common import cache
+
+
+class Clock:
+    """Stands in for the time module in common.cache, so that tests can let time pass"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def local_cache(monkeypatch):
+    """Runs the test with an empty cache that is local to the process"""
+
+    monkeypatch.setattr(cache, '_initialized', True)
+    monkeypatch.setattr(cache, '_redis_client', None)
+    monkeypatch.setattr(cache, '_cache_backend', None)
+    monkeypatch.setattr(cache, '_key_prefix', '')
+    monkeypatch.setattr(cache, '_local_cache', cache.LocalCache(1024 * 1024))
+    monkeypatch.setattr(cache, '_local_claims', {})
+    monkeypatch.setattr(cache, '_local_records', {})
+    return cache
@@ -0,0 +1,98 @@
+import pytest
+
+from common import cache
+
+
+class FakeRedis:
+    """Runs the claim scripts of common.cache against a dict, honoring the expiry times"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.values = {}
+        self.calls = []
+
+    def _get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and self.clock.monotonic() >= expires_at:
+            del self.values[key]
+            return None
+        return value
+
+    def eval(self, script, nr_keys, key, *args):
+        self.calls.append((script, nr_keys, key) + args)
+        current = self._get(key)
+        owner = args[0].encode('utf8')
+        if script == cache.CLAIM_SCRIPT:
+            if current is None or current == owner:
+                self.values[key] = (owner, self.clock.monotonic() + args[1] / 1000)
+                return owner
+            return current
+        if script == cache.RELEASE_SCRIPT:
+            if current == owner:
+                del self.values[key]
+                return 1
+            return 0
+        raise AssertionError('Unknown script')
+
+
+@pytest.fixture(params=['local', 'redis'])
+def claim_cache(request, local_cache, clock, monkeypatch):
+    if request.param == 'redis':
+        monkeypatch.setattr(cache, '_redis_client', FakeRedis(clock))
+        monkeypatch.setattr(cache, '_key_prefix', 'test-')
+    return cache
+
+
+def test_second_claimant_waits(claim_cache):
+    assert claim_cache.claim('job', 10, owner='a') == (True, 'a')
+    assert claim_cache.claim('job', 10, owner='b') == (False, 'a')
+
+    assert claim_cache.release_claim('job', 'a')
+    assert claim_cache.claim('job', 10, owner='b') == (True, 'b')
+
+
+def test_owner_extends_claim(claim_cache, clock):
+    assert claim_cache.claim('job', 10, owner='a') == (True, 'a')
+    clock.advance(8)
+    assert claim_cache.claim('job', 10, owner='a') == (True, 'a')
+    clock.advance(8)
+    assert claim_cache.claim('job', 10, owner='b') == (False, 'a')
+
+
+def test_claim_of_dead_claimant_expires(claim_cache, clock):
+    assert claim_cache.claim('job', 10, owner='a') == (True, 'a')
+    clock.advance(9)
+    assert claim_cache.claim('job', 10, owner='b') == (False, 'a')
+    clock.advance(1)
+    assert claim_cache.claim('job', 10, owner='b') == (True, 'b')
+    # The claim of the dead claimant is gone, so it cannot release the new one
+    assert not claim_cache.release_claim('job', 'a')
+    assert claim_cache.claim('job', 10, owner='c') == (False, 'b')
+
+
+def test_claim_released_only_by_owner(claim_cache):
+    assert claim_cache.claim('job', 10, owner='a') == (True, 'a')
+    assert not claim_cache.release_claim('job', 'b')
+    assert claim_cache.claim('job', 10, owner='b') == (False, 'a')
+
+    assert claim_cache.release_claim('job', 'a')
+    assert not claim_cache.release_claim('job', 'a')
+
+
+def test_claim_generates_owner(claim_cache):
+    claimed, owner = claim_cache.claim('job', 10)
+    assert claimed
+    assert claim_cache.claim('job', 10) == (False, owner)
+
+
+def test_claims_use_key_prefix(local_cache, clock, monkeypatch):
+    redis = FakeRedis(clock)
+    monkeypatch.setattr(cache, '_redis_client', redis)
+    monkeypatch.setattr(cache, '_key_prefix', 'test-')
+
+    cache.claim('job', 1.5, owner='a')
+    cache.release_claim('job', 'a')
+    assert redis.calls == [
+        (cache.CLAIM_SCRIPT, 1, 'test-job', 'a', 1500),
+        (cache.RELEASE_SCRIPT, 1, 'test-job', 'a'),
+    ]
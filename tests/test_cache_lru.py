@@ -0,0 +1,146 @@
+import pytest
+
+from common import cache, cache_serialization
+
+VALUE = 'x' * 1000
+
+
+class FakeRedis:
+    """Keeps the values and version tags of common.cache in a dict and records the calls"""
+
+    def __init__(self):
+        self.values = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self.values.get(key)
+
+    def mget(self, keys):
+        self.calls.append(('mget',) + tuple(keys))
+        return [self.values.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def store(self, key, value, version):
+        """Stores the value like another process would"""
+        self.values[key] = cache_serialization.dumps(value)
+        self.values[key + cache.VERSION_SUFFIX] = version.encode('utf8')
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        self.commands.append((key, value))
+
+    def execute(self):
+        for key, value in self.commands:
+            self.redis.values[key] = value
+
+
+@pytest.fixture
+def redis(local_cache, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(cache, '_redis_client', redis)
+    return redis
+
+
+def test_lru_evicts_least_recently_used():
+    size = cache.estimate_size(VALUE)
+    lru = cache.LocalCache(size * 2 + size // 2)
+    lru.set('a', VALUE, 'v', None, 0, 0)
+    lru.set('b', VALUE, 'v', None, 0, 0)
+    assert lru.get('a', 0) is not None
+
+    lru.set('c', VALUE, 'v', None, 0, 0)
+    assert list(lru.entries) == ['a', 'c']
+    assert lru.get('b', 0) is None
+    assert lru.nr_bytes == size * 2
+
+
+def test_lru_replaces_entry():
+    size = cache.estimate_size(VALUE)
+    lru = cache.LocalCache(size * 3)
+    lru.set('a', VALUE, 'v1', None, 0, 0)
+    lru.set('b', VALUE, 'v1', None, 0, 0)
+    lru.set('a', VALUE, 'v2', None, 0, 0)
+    assert list(lru.entries) == ['b', 'a']
+    assert lru.get('a', 0).version == 'v2'
+    assert lru.nr_bytes == size * 2
+
+
+def test_lru_skips_values_over_limit():
+    size = cache.estimate_size(VALUE)
+    lru = cache.LocalCache(size - 1)
+    lru.set('a', VALUE, 'v', None, 0, 0)
+    assert lru.get('a', 0) is None
+    assert lru.nr_bytes == 0
+
+
+def test_lru_entry_expires():
+    lru = cache.LocalCache(1024 * 1024)
+    lru.set('a', VALUE, 'v', 10, 0, 0)
+    assert lru.get('a', 9) is not None
+    assert lru.get('a', 10) is None
+    assert lru.nr_bytes == 0
+
+
+def test_local_copy_trusted_for_local_timeout(redis, clock):
+    cache.set('key', dict(value=1), local_timeout=10)
+    redis.store('key', dict(value=2), 'other:0')
+    redis.calls = []
+
+    clock.advance(9)
+    assert cache.get('key') == dict(value=1)
+    assert redis.calls == []
+
+    clock.advance(1)
+    assert cache.get('key') == dict(value=2)
+
+
+def test_local_copy_revalidated_by_version(redis, clock):
+    cache.set('key', dict(value=1))
+    redis.calls = []
+
+    assert cache.get('key') == dict(value=1)
+    # Only the version tag was fetched
+    assert redis.calls == [('get', 'key' + cache.VERSION_SUFFIX)]
+
+
+def test_changed_version_invalidates_local_copy(redis, clock):
+    cache.set('key', dict(value=1))
+    redis.store('key', dict(value=2), 'other:0')
+    redis.calls = []
+
+    assert cache.get('key') == dict(value=2)
+    assert redis.calls[-1] == ('mget', 'key', 'key' + cache.VERSION_SUFFIX)
+    assert cache._local_cache.get('key', clock.monotonic()).version == 'other:0'
+
+    redis.calls = []
+    assert cache.get('key') == dict(value=2)
+    assert redis.calls == [('get', 'key' + cache.VERSION_SUFFIX)]
+
+
+def test_missing_remote_value_drops_local_copy(redis, clock):
+    cache.set('key', dict(value=1))
+    redis.values.clear()
+
+    assert cache.get('key') is None
+    assert cache._local_cache.get('key', clock.monotonic()) is None
+
+
+def test_local_copy_is_not_shared_with_caller(local_cache):
+    value = dict(values=[1, 2])
+    cache.set('key', value)
+    value['values'].append(3)
+
+    got = cache.get('key')
+    assert got == dict(values=[1, 2])
+    got['values'].append(4)
+    assert cache.get('key') == dict(values=[1, 2])
@@ -0,0 +1,107 @@
+import pickle
+
+import flask
+import numpy as np
+import pandas as pd
+import pytest
+
+from common import cache, cache_serialization
+
+COMPRESSIONS = [None] + [
+    name for name in cache_serialization.CODECS if cache_serialization.is_codec_available(name)
+]
+
+
+def make_frame():
+    df = pd.DataFrame(dict(
+        ints=np.arange(100, dtype='i'),
+        floats=np.linspace(0, 1, 100),
+        strs=['x%d' % i for i in range(100)],
+    ), index=pd.date_range('2020-01-01', periods=100))
+    df.loc[df.index[::7], 'floats'] = np.nan
+    df.loc[df.index[::9], 'strs'] = None
+    return df
+
+
+def round_trip(obj, compression):
+    data = cache_serialization.dumps(obj, compression)
+    assert cache_serialization.is_serialized(data)
+    return cache_serialization.loads(data)
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_frame_round_trip(compression):
+    df = make_frame()
+    pd.testing.assert_frame_equal(round_trip(df, compression), df)
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_array_round_trip(compression):
+    arrays = [
+        np.arange(1000, dtype=np.int32),
+        np.array([1.5, np.nan, -np.inf, 0]),
+        np.arange(24, dtype=np.float32).reshape(2, 3, 4),
+        # Not contiguous
+        np.arange(100)[::3],
+        np.array([], dtype=np.int64),
+    ]
+    for arr in arrays:
+        out = round_trip(arr, compression)
+        assert out.dtype == arr.dtype
+        np.testing.assert_array_equal(out, arr)
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_value_round_trip(compression):
+    for obj in [None, 0, 'x', float('nan'), [], dict(a=None, b=[1, 2.5, None])]:
+        out = round_trip(obj, compression)
+        if isinstance(obj, float):
+            assert np.isnan(out)
+        else:
+            assert out == obj
+
+
+def test_nested_round_trip():
+    df = make_frame()
+    obj = dict(total=df, age_groups=df[['ints']], arr=np.ones(10), none=None)
+    out = round_trip(obj, None)
+    pd.testing.assert_frame_equal(out['total'], df)
+    pd.testing.assert_frame_equal(out['age_groups'], df[['ints']])
+    np.testing.assert_array_equal(out['arr'], np.ones(10))
+    assert out['none'] is None
+
+
+def test_loaded_arrays_are_writable():
+    out = round_trip(np.zeros(10), None)
+    out[0] = 1
+    assert out[0] == 1
+
+
+def test_compression_threshold():
+    arr = np.zeros(1000)
+    available = [x for x in COMPRESSIONS if x is not None]
+    if not available:
+        pytest.skip('No compression codecs installed')
+
+    small = cache_serialization.dumps(arr, available[0], compress_min_bytes=100000)
+    assert small[len(cache_serialization.MAGIC)] == cache_serialization.CODEC_NONE
+    large = cache_serialization.dumps(arr, available[0], compress_min_bytes=100)
+    assert large[len(cache_serialization.MAGIC)] == cache_serialization.CODECS[available[0]]
+    assert len(large) < len(small)
+    np.testing.assert_array_equal(cache_serialization.loads(large), arr)
+
+
+def test_plain_pickle_is_not_serialized():
+    assert not cache_serialization.is_serialized(pickle.dumps(make_frame()))
+
+
+def test_init_app_keeps_serialization(local_cache, monkeypatch):
+    monkeypatch.setattr(cache, 'memoize', None, raising=False)
+    app = flask.Flask(__name__)
+    app.config.update(CACHE_TYPE='simple', CACHE_KEY_PREFIX='test')
+    get, set = cache.get, cache.set
+
+    cache.init_app(app)
+    assert cache.get is get
+    assert cache.set is set
+    assert cache.memoize is not None
@@ -0,0 +1,72 @@
+import base64
+
+import numpy as np
+import pandas as pd
+
+from calc.metric_values import encode_values, to_float_array, to_json_values
+
+
+def decode_values(encoded):
+    """Decodes the output of encode_values() the way an API client would"""
+
+    dtype = '<i4' if encoded['dtype'] == 'int32' else '<f4'
+    arr = np.frombuffer(base64.b64decode(encoded['data']), dtype=dtype).reshape(encoded['shape'])
+    values = arr.ravel().tolist()
+    if encoded['null_bitmap'] is not None:
+        bits = np.unpackbits(
+            np.frombuffer(base64.b64decode(encoded['null_bitmap']), dtype=np.uint8), bitorder='little'
+        )
+        for idx in np.flatnonzero(bits[:len(values)]):
+            values[idx] = None
+    return values
+
+
+def test_encode_integers():
+    arr = np.array([0, 1, -5, 2 ** 31 - 1], dtype=np.int64)
+    encoded = encode_values(arr, is_integer=True)
+    assert encoded['dtype'] == 'int32'
+    assert encoded['shape'] == [4]
+    assert encoded['null_bitmap'] is None
+    assert decode_values(encoded) == [0, 1, -5, 2 ** 31 - 1]
+
+
+def test_encode_integers_with_nulls():
+    arr = to_float_array(pd.Series([1, None, 3, None, 5] * 3, dtype='Int64'))
+    encoded = encode_values(arr, is_integer=True)
+    assert encoded['dtype'] == 'int32'
+    assert decode_values(encoded) == to_json_values(arr, is_integer=True)
+    assert decode_values(encoded)[:5] == [1, None, 3, None, 5]
+
+
+def test_encode_floats():
+    arr = np.array([0.5, -1.25, 1e6])
+    encoded = encode_values(arr, is_integer=False)
+    assert encoded['dtype'] == 'float32'
+    assert encoded['null_bitmap'] is None
+    assert decode_values(encoded) == [0.5, -1.25, 1e6]
+
+
+def test_encode_floats_with_nulls():
+    arr = np.array([np.nan, 0.25, np.nan, 2.0, 0.0, 0.0, 0.0, 0.0, np.nan])
+    encoded = encode_values(arr, is_integer=False)
+    assert decode_values(encoded) == [None, 0.25, None, 2.0, 0.0, 0.0, 0.0, 0.0, None]
+    assert decode_values(encoded) == to_json_values(arr, is_integer=False)
+
+
+def test_encode_all_nulls():
+    arr = np.full(3, np.nan)
+    assert decode_values(encode_values(arr, is_integer=True)) == [None, None, None]
+    assert decode_values(encode_values(arr, is_integer=False)) == [None, None, None]
+
+
+def test_encode_2d():
+    arr = np.array([[1.0, np.nan], [3.0, 4.0], [np.nan, 6.0]])
+    encoded = encode_values(arr, is_integer=True)
+    assert encoded['shape'] == [3, 2]
+    assert decode_values(encoded) == [1, None, 3, 4, None, 6]
+
+
+def test_encode_empty():
+    encoded = encode_values(np.array([], dtype=np.float64), is_integer=False)
+    assert encoded['shape'] == [0]
+    assert decode_values(encoded) == []
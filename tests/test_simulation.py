@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from calc.simulation import create_context, expand_contact_matrix
+from cythonsim import model
+from variables import copy_variables
+
+POPULATION_PER_AGE = 100
+DAYS = 20
+
+
+def make_variables():
+    variables = copy_variables()
+    variables['simulation_days'] = DAYS
+    return variables
+
+
+def make_age_structure(variables):
+    max_age = variables['max_age']
+    return pd.Series([POPULATION_PER_AGE] * (max_age + 1), index=range(0, max_age + 1))
+
+
+def assert_states_equal(a, b):
+    assert a.keys() == b.keys()
+    for key, val in a.items():
+        other = b[key]
+        if isinstance(val, pd.Series):
+            pd.testing.assert_series_equal(val, other, check_exact=True)
+        elif isinstance(val, np.ndarray):
+            np.testing.assert_array_equal(val, other)
+        elif key == 'phase_timings':
+            # Wall times differ between any two runs
+            assert val.keys() == other.keys()
+        else:
+            assert val == other, key
+
+
+def test_clone_produces_the_same_run():
+    variables = make_variables()
+    fresh = create_context(variables, age_structure=make_age_structure(variables))
+    template = create_context(variables, age_structure=make_age_structure(variables))
+    clone = template.clone()
+
+    for day in range(DAYS):
+        assert_states_equal(fresh.generate_state(), clone.generate_state())
+        fresh.iterate()
+        clone.iterate()
+    assert_states_equal(fresh.generate_state(), clone.generate_state())
+
+    # The template itself is left pristine
+    assert template.day == 0
+
+
+def make_contact_matrix_frame(zero_age_range=None):
+    """Returns a contact matrix in the format of get_contacts_for_country()"""
+
+    age_ranges = ['0-4', '5-9', '10-14', '15-19', '20-100']
+    places = ['home', 'work', 'school', 'transport', 'leisure', 'other']
+    rng = np.random.default_rng(1234)
+    rows = []
+    for place in places:
+        for participant_age in age_ranges:
+            values = rng.uniform(0, 3, len(age_ranges))
+            if participant_age == zero_age_range:
+                values[:] = 0
+            rows.append([place, participant_age] + list(values))
+    return pd.DataFrame(rows, columns=['place_type', 'participant_age'] + age_ranges)
+
+
+def get_baseline_probabilities(df, nr_ages):
+    """Computes the contact probabilities the way the engine did before the contacts were integer-coded"""
+
+    df = pd.melt(df, id_vars=['place_type', 'participant_age'], var_name='contact_age', value_name='contacts')
+    df['participant_age'] = df['participant_age'].map(lambda x: tuple([int(y) for y in x.split('-')]))
+    df['contact_age'] = df['contact_age'].map(lambda x: tuple([int(y) for y in x.split('-')]))
+    df = pd.DataFrame(
+        [
+            (t.place_type, p, t.contact_age, t.contacts) for t in df.itertuples()
+            for p in range(t.participant_age[0], t.participant_age[1] + 1)
+        ],
+        columns=['place_type', 'participant_age', 'contact_age', 'contacts']
+    )
+    total_contacts = df.groupby('participant_age')['contacts'].sum()
+    df = df.set_index(['place_type', 'participant_age', 'contact_age']).sort_index()
+    df = df.unstack('participant_age')
+    df.columns = df.columns.droplevel(0)
+    df = df.divide(total_contacts, axis=1).cumsum()
+
+    out = {}
+    for age in range(nr_ages):
+        out[age] = [
+            (place, contact_age[0], contact_age[1], cum_p) for (place, contact_age), cum_p in df[age].items()
+        ]
+    return out
+
+
+def test_contact_probabilities_match_baseline():
+    nr_ages = 101
+    df = make_contact_matrix_frame()
+    cm = model.ContactMatrix(expand_contact_matrix(df), nr_ages)
+    baseline = get_baseline_probabilities(df, nr_ages)
+
+    for age in range(nr_ages):
+        probabilities = cm.get_contact_probabilities(age)
+        assert [x[:3] for x in probabilities] == [x[:3] for x in baseline[age]]
+        np.testing.assert_allclose([x[3] for x in probabilities], [x[3] for x in baseline[age]])
+
+
+def test_contact_probabilities_with_no_contacts():
+    nr_ages = 101
+    cm = model.ContactMatrix(expand_contact_matrix(make_contact_matrix_frame(zero_age_range='5-9')), nr_ages)
+
+    for age in range(5, 10):
+        assert all(x[3] == 0 for x in cm.get_contact_probabilities(age))
+    assert cm.get_contact_probabilities(4)[-1][3] == pytest.approx(1.0)
+
+
+def test_sampled_contacts_are_reproducible():
+    variables = make_variables()
+    samples = []
+    for i in range(2):
+        context = create_context(variables, age_structure=make_age_structure(variables))
+        samples.append([context.sample('contacts_per_day', age) for age in (5, 30, 70)])
+
+    for a, b in zip(*samples):
+        np.testing.assert_array_equal(a, b)
@@ -0,0 +1,46 @@
+from simulation_thread import (
+    ACTIVE_RUN_EXPIRATION, CACHE_EXPIRATION, get_run_results, get_run_state, update_run_state,
+)
+
+
+def test_run_state_is_written_and_read(local_cache, clock):
+    assert get_run_state('run') is None
+
+    update_run_state('run', finished=False, error=None)
+    update_run_state('run', results=dict(total=[1, 2]), version='v1')
+    assert get_run_state('run') == dict(finished=False, error=None, results=dict(total=[1, 2]), version='v1')
+    assert get_run_state('run', fields=('finished', 'version')) == dict(finished=False, version='v1')
+    assert get_run_results('run') == dict(total=[1, 2])
+
+    # Updates replace only the given fields
+    update_run_state('run', finished=True)
+    assert get_run_state('run')['finished'] is True
+    assert get_run_state('run')['version'] == 'v1'
+
+
+def test_run_state_is_a_copy(local_cache, clock):
+    update_run_state('run', results=dict(total=[1, 2]))
+    get_run_state('run')['results']['total'].append(3)
+    assert get_run_results('run') == dict(total=[1, 2])
+
+
+def test_finished_run_state_expires(local_cache, clock):
+    update_run_state('run', finished=True)
+    clock.advance(CACHE_EXPIRATION - 1)
+    assert get_run_state('run') is not None
+    clock.advance(1)
+    assert get_run_state('run') is None
+
+
+def test_active_run_state_honors_expiration(local_cache, clock):
+    update_run_state('run', timeout=ACTIVE_RUN_EXPIRATION, finished=False, queued=True)
+    clock.advance(ACTIVE_RUN_EXPIRATION - 1)
+    assert get_run_state('run') == dict(finished=False, queued=True)
+
+    # Every update renews the expiration
+    update_run_state('run', timeout=ACTIVE_RUN_EXPIRATION, queued=False)
+    clock.advance(ACTIVE_RUN_EXPIRATION - 1)
+    assert get_run_state('run') == dict(finished=False, queued=False)
+
+    clock.advance(1)
+    assert get_run_state('run') is None
@@ -1,6 +1,7 @@
 import hashlib
 import json
 import os
+import uuid
 from contextlib import contextmanager
 
 import flask
@@ -485,6 +486,7 @@ if _variable_override_set:
 
 # Variable overrides that are set later programmatically
 _variable_overrides = {}
+_variable_override_versions = {}
 
 # Make a hash of the default variables so that when they change,
 # we will reset everybody's custom session variables.
@@ -501,14 +503,46 @@ def set_variable(var_name, value):
         if not _allow_variable_set:
             raise Exception('Should not set variable outside of request context')
         _variable_overrides[var_name] = value
+        _variable_override_versions[var_name] = uuid.uuid4().hex
         return
 
     if value == VARIABLE_DEFAULTS[var_name]:
         if var_name in session:
             del session[var_name]
+        _set_session_variable_version(var_name, None)
         return
 
     session[var_name] = value
+    _set_session_variable_version(var_name, uuid.uuid4().hex)
+
+
+def _set_session_variable_version(var_name, version):
+    versions = dict(session.get('variable_versions', {}))
+    if version is None:
+        versions.pop(var_name, None)
+    else:
+        versions[var_name] = version
+    session['variable_versions'] = versions
+
+
+def get_variable_version(var_name):
+    """Returns a token that changes whenever the variable is set in the current context.
+
+    Variables that have their default value share the same token. Returns
+    None if the version is not known.
+    """
+    if flask.has_request_context():
+        if session.get('default_variable_hash', '') != DEFAULT_VARIABLE_HASH:
+            reset_variables()
+        versions = session.get('variable_versions', {})
+        if var_name in versions:
+            return versions[var_name]
+        if var_name in session:
+            # Set before the versions were tracked
+            return None
+        return DEFAULT_VARIABLE_HASH
+
+    return _variable_override_versions.get(var_name, DEFAULT_VARIABLE_HASH)
 
 
 def get_variable(var_name, var_store=None):
@@ -538,9 +572,11 @@ def reset_variable(var_name):
     if flask.has_request_context():
         if var_name in session:
             del session[var_name]
+        _set_session_variable_version(var_name, None)
     else:
         if var_name in _variable_overrides:
             del _variable_overrides[var_name]
+        _variable_override_versions.pop(var_name, None)
 
 
 def reset_variables():
@@ -550,8 +586,10 @@ def reset_variables():
             if var_name not in session:
                 continue
             del session[var_name]
+        session['variable_versions'] = {}
     else:
         _variable_overrides.clear()
+        _variable_override_versions.clear()
 
 
 def get_session_variables():